@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+METADATA_FILE = 'metadata.json'
+
+# Separator used to store list-valued columns as strings
+LIST_SEPARATOR = '|'
+
+
+def _uri_hashes(uris):
+    # Stable across processes, unlike hash()
+    return np.fromiter((int.from_bytes(hashlib.blake2b(uri.encode('utf-8'), digest_size=8).digest(), 'little')
+                        for uri in uris), dtype=np.uint64, count=len(uris))
+
+
+class StringColumn:
+    """
+    Strings stored back to back in a single UTF-8 buffer, with the offset of every string. Indexing decodes only
+    the requested strings, so the buffer can be memory-mapped and shared by every process reading it. Missing
+    values are returned as NaN and list-valued columns are split on access, as in the original table.
+    """
+
+    def __init__(self, data, offsets, nulls, is_list=False):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+        self.is_list = is_list
+
+        # Slicing a memoryview is much cheaper than slicing a memmap
+        self._buffer = memoryview(np.asarray(data))
+
+    @classmethod
+    def from_values(cls, values, is_list=False):
+        encoded = []
+        nulls = np.zeros(len(values), dtype=bool)
+        for i, value in enumerate(values):
+            if is_list:
+                value = LIST_SEPARATOR.join(value)
+            elif not isinstance(value, str):
+                nulls[i] = True
+                value = ''
+
+            encoded.append(value.encode('utf-8'))
+
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, nulls, is_list)
+
+    @classmethod
+    def load(cls, path, name, is_list=False, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(path, f'{name}.{part}.npy'), mmap_mode=mmap_mode)
+                     for part in ['data', 'offsets', 'nulls']], is_list)
+
+    def save(self, path, name):
+        for part, array in [('data', self.data), ('offsets', self.offsets), ('nulls', self.nulls)]:
+            np.save(os.path.join(path, f'{name}.{part}.npy'), array)
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def _decode(self, start, end, null):
+        if null:
+            return np.nan
+
+        value = str(self._buffer[start:end], 'utf-8')
+
+        return value.split(LIST_SEPARATOR) if self.is_list else value
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._decode(int(self.offsets[key]), int(self.offsets[key + 1]), self.nulls[key])
+
+        # Slices, masks and position arrays behave as on a numpy array
+        positions = np.arange(len(self))[key]
+        bounds = zip(self.offsets[positions].tolist(), self.offsets[positions + 1].tolist(),
+                     self.nulls[positions].tolist())
+
+        values = np.empty(len(positions), dtype=object)
+        values[:] = [self._decode(start, end, null) for start, end, null in bounds]
+
+        return values
+
+
+class MovieCatalog:
+    """
+    Read-only, columnar movies table. Numeric columns are numpy arrays and text columns are StringColumns, so a
+    catalog opened from disk is memory-mapped and shared between worker processes rather than copied into each.
+    URIs are resolved to row positions through a sorted array of URI hashes, which is shared the same way.
+    """
+
+    def __init__(self, arrays, hashes=None, positions=None, metadata=None):
+        self.columns = list(arrays)
+        self._arrays = arrays
+        self.metadata = metadata or {}
+
+        if hashes is None:
+            hashes, positions = self._build_index(arrays['uri'])
+
+        self._hashes = hashes
+        self._positions = positions
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls({column: frame[column].values for column in frame.columns})
+
+    @staticmethod
+    def _build_index(uris):
+        hashes = _uri_hashes(uris)
+
+        # The old mask lookup returned the first matching row, so duplicated URIs keep their first position
+        order = np.lexsort((np.arange(len(hashes)), hashes))
+        hashes = hashes[order]
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = hashes[1:] != hashes[:-1]
+
+        for duplicate in np.flatnonzero(~first):
+            group = np.searchsorted(hashes, hashes[duplicate])
+            if uris[order[duplicate]] != uris[order[group]]:
+                raise ValueError(f'Hash collision between {uris[order[group]]} and {uris[order[duplicate]]}')
+
+        return hashes[first], order[first].astype(np.int64)
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """
+        Maps a catalog written by write. Nothing but the metadata is read until rows are accessed.
+        """
+        with open(os.path.join(path, METADATA_FILE), 'r') as fp:
+            metadata = json.load(fp)
+
+        arrays = {}
+        for column in metadata['columns']:
+            name, kind = column['name'], column['kind']
+            if kind == 'numeric':
+                arrays[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+            else:
+                arrays[name] = StringColumn.load(path, name, kind == 'list', mmap_mode)
+
+        hashes, positions = [np.load(os.path.join(path, f'index.{part}.npy'), mmap_mode=mmap_mode)
+                             for part in ['hashes', 'positions']]
+
+        return cls(arrays, hashes, positions, metadata['extra'])
+
+    def write(self, path, **extra):
+        """
+        Writes the catalog as one file per array, replacing any catalog at path. Processes that still map the
+        previous files keep reading them until they reopen the catalog.
+        """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        columns = []
+        for name, values in self._arrays.items():
+            if isinstance(values, StringColumn):
+                kind = 'list' if values.is_list else 'string'
+                values.save(temporary, name)
+            elif values.dtype.kind in 'biuf':
+                kind = 'numeric'
+                np.save(os.path.join(temporary, f'{name}.npy'), values)
+            else:
+                kind = 'list' if any(isinstance(value, list) for value in values) else 'string'
+                StringColumn.from_values(values, kind == 'list').save(temporary, name)
+
+            columns.append({'name': name, 'kind': kind})
+
+        np.save(os.path.join(temporary, 'index.hashes.npy'), self._hashes)
+        np.save(os.path.join(temporary, 'index.positions.npy'), self._positions)
+
+        # The metadata is written last, so a partially written catalog is never opened
+        with open(os.path.join(temporary, METADATA_FILE), 'w') as fp:
+            json.dump({'columns': columns, 'extra': extra}, fp)
+
+        previous = f'{path}.{os.getpid()}.old'
+        if os.path.exists(path):
+            os.rename(path, previous)
+
+        os.rename(temporary, path)
+        shutil.rmtree(previous, ignore_errors=True)
+
+    @staticmethod
+    def update_metadata(path, **extra):
+        """
+        Replaces entries of the extra metadata of the catalog at path, leaving its arrays as they are.
+        """
+        file = os.path.join(path, METADATA_FILE)
+        with open(file, 'r') as fp:
+            metadata = json.load(fp)
+
+        metadata['extra'].update(extra)
+
+        temporary = f'{file}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as fp:
+            json.dump(metadata, fp)
+
+        os.replace(temporary, file)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, uri):
+        return self.position(uri) >= 0
+
+    def position(self, uri):
+        return int(self.positions([uri])[0])
+
+    def positions(self, uris):
+        """
+        Resolves a list of URIs to row positions in one vectorized call. Unknown URIs map to -1.
+        """
+        if not len(uris) or not len(self._hashes):
+            return np.full(len(uris), -1, dtype=np.int64)
+
+        uris = list(uris)
+        hashes = _uri_hashes(uris)
+        indices = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+        positions = np.where(self._hashes[indices] == hashes, self._positions[indices], -1)
+
+        # A matching hash is only a match if the URI is the same
+        found = np.flatnonzero(positions >= 0)
+        if len(found):
+            stored = self._arrays['uri'][positions[found]]
+            mismatched = [i for i, uri in zip(found, stored) if uri != uris[i]]
+            positions[mismatched] = -1
+
+        return positions
+
+    def column(self, name, positions=None):
+        if positions is None:
+            return self._arrays[name]
+
+        return self._arrays[name][positions]
+
+    def row(self, position):
+        return {column: self._arrays[column][position] for column in self.columns}
+
+    def rows(self, positions):
+        columns = {column: array[positions] for column, array in self._arrays.items()}
+
+        return [{column: columns[column][i] for column in self.columns} for i in range(len(positions))]
+
+    def get(self, uri):
+        position = self.position(uri)
+
+        return self.row(position) if position >= 0 else None
+
+    def lookup(self, uris):
+        """
+        Bulk variant of get. Returns a list aligned with uris, with None for URIs that are not movies.
+        """
+        positions = self.positions(uris)
+        found = positions >= 0
+
+        rows = iter(self.rows(positions[found]))
+
+        return [next(rows) if is_found else None for is_found in found]
+
+    def frame(self):
+        """
+        Materializes the catalog as a DataFrame, for offline scripts.
+        """
+        return pd.DataFrame({column: self._arrays[column][:] for column in self.columns})
@@ -5,8 +5,12 @@ UNKNOWN = 'unknown'
 TIMESTAMPS = 'timestamps'
 FINAL = 'final'
 VERSION = 'version'
+SEQUENCE = 'sequence'
 POPULARITY = 'popularity_sampled'
 SESSION_PATH = 'sessions'
+SESSION_DATABASE = 'sessions.db'
+EXPORT_PATH = 'exports'
+GRAPH_CSV_PATH = 'wikidata/data/csv'
 
 # How many questions to ask the user before showing predictions
 MIN_QUESTIONS = 30
@@ -29,3 +33,40 @@ LAST_N_REC_QUESTIONS = 3
 # All sessions are saved with their current session
 # As of september 2020, versioning is by month and year
 CURRENT_VERSION = 'june-2024'
+
+# Session journals are compacted into a snapshot once they grow past this size (in bytes)
+JOURNAL_COMPACT_BYTES = 64 * 1024
+
+# How often (in seconds) statistics pick up sessions written by other workers
+STATISTICS_SYNC_INTERVAL = 10
+
+# How often (in seconds) the graph fingerprint used to version exports is recomputed
+FINGERPRINT_INTERVAL = 60
+
+# A graph export lock file older than this (in seconds) was left by a worker that died while building the export
+EXPORT_LOCK_TIMEOUT = 10 * 60
+
+# Particle filtering results are cached per seed set, holding this many seed sets for this many seconds
+NEIGHBOR_CACHE_SIZE = 1024
+NEIGHBOR_CACHE_TTL = 60 * 60
+
+# How many extra results are cached per group, to leave enough after removing a user's seen entities
+NEIGHBOR_CACHE_OVERFETCH = 50
+
+# Graph queries run on a pool of this many threads shared by all requests, with at most this many waiting
+QUERY_WORKERS = 8
+QUERY_QUEUE_SIZE = 64
+
+# How long (in seconds) a page waits for its graph query before falling back to popularity samples
+QUERY_DEADLINE = 5
+
+# How often (in seconds) the number of entities per label, used to stratify samples, is recounted
+ENTITY_COUNTS_INTERVAL = 60 * 60
+
+# How long (in seconds) to wait before retrying a failed warm-up task, such as connecting to the graph
+WARMUP_RETRY_INTERVAL = 5
+
+# Session files are decoded by a pool of this many processes per worker, shared by all its requests, in chunks of this
+# many files. With fewer than 2 processes, the worker decodes them itself
+SESSION_LOAD_PROCESSES = 4
+SESSION_LOAD_CHUNK_SIZE = 500
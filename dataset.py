@@ -1,10 +1,15 @@
-import gc
+import argparse
+import hashlib
 import os
 import re
+import threading
 
 import numpy as np
 import pandas as pd
 
+from catalog import MovieCatalog
+from utility.weighted_sampler import WeightedSampler
+
 NUM_RATINGS_MAP = {}  # Cache
 
 
@@ -48,17 +53,22 @@ def get_sampling_score(movie_id, k=2000):
 
 
 def sample(count, exclude):
-    relevant = movies[~movies.uri.isin(exclude)]
+    """
+    Samples count movies by weight, excluding the catalog positions in exclude (negative positions are ignored).
+    """
+    exclude = np.asarray(exclude, dtype=np.int64)
 
-    return relevant.sample(n=count, weights=relevant.weight)
+    return get_catalog().rows(get_sampler().sample(count, exclude[exclude >= 0]))
 
 
 def get_unseen(seen):
+    movies, links = _table('movies'), _table('links')
     tmp = ratings.merge(movies).merge(links).drop_duplicates(['movieId'])["uri"]
     return list(set(tmp) - set(seen))
 
 
 def get_movies_by_id(movie_ids):
+    movies = _table('movies')
     return movies[movies.movieId.isin(movie_ids)]
 
 
@@ -67,7 +77,7 @@ def get_names(movie_ids):
 
 
 def get_movies_iter():
-    return movies.iterrows()
+    return _table('movies').iterrows()
 
 
 def get_num_ratings(movie_id): 
@@ -77,66 +87,261 @@ def get_num_ratings(movie_id):
 
 
 def get_year(movie_id): 
+    movies = _table('movies')
     return int(movies[movies['movieId'] == movie_id]['year'].values[-1])
 
 
 DATA_PATH = 'data'
 ml_path = os.path.join(DATA_PATH, 'movielens')
 
-# Load from JSON
-# actors = json.load(open(f'{DATA_PATH}/actors.json', 'r'))
+# The final movies table as a memory-mapped catalog, written by `python dataset.py build`
+ARTIFACT_PATH = os.path.join(ml_path, 'catalog')
+
+# Bump whenever the pipeline below changes, so older artifacts are rebuilt
+ARTIFACT_VERSION = 3
+
+# How many ratings are read at a time
+RATINGS_CHUNK_SIZE = 1000000
+
+SOURCE_FILES = ['movies.csv', 'ratings.csv', 'links.csv', 'mapping.csv', 'summaries.csv']
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _source_fingerprint():
+    """
+    Identifies the source files an artifact is built from by their contents. Their size and modification time are
+    kept as well, so that unchanged files need not be hashed again.
+    """
+    files = {}
+    for file in SOURCE_FILES:
+        path = os.path.join(ml_path, file)
+        stat = os.stat(path)
+        files[file] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': _file_hash(path)}
+
+    return {'version': ARTIFACT_VERSION, 'files': files}
+
+
+def _is_current(fingerprint):
+    """
+    Whether an artifact was built from the source files present, and the fingerprint to store if files were only
+    touched. Files are compared by contents, so copies and fresh checkouts still match, and missing files are not
+    compared, so an artifact can be deployed without them. A file whose hash matches gets its modification time
+    refreshed, so it is hashed once rather than on every start.
+    """
+    if not isinstance(fingerprint, dict) or fingerprint.get('version') != ARTIFACT_VERSION:
+        return False, None
+
+    refreshed = {}
+    for file in SOURCE_FILES:
+        path = os.path.join(ml_path, file)
+        if not os.path.exists(path):
+            continue
+
+        stored = fingerprint['files'][file]
+        stat = os.stat(path)
+        if stat.st_size != stored['size']:
+            return False, None
+
+        if stat.st_mtime_ns != stored['mtime_ns']:
+            if _file_hash(path) != stored['hash']:
+                return False, None
+
+            refreshed[file] = dict(stored, mtime_ns=stat.st_mtime_ns)
+
+    if not refreshed:
+        return True, None
+
+    return True, dict(fingerprint, files=dict(fingerprint['files'], **refreshed))
+
+
+def count_ratings(path, chunk_size=RATINGS_CHUNK_SIZE):
+    """
+    Number of ratings per movieId, read chunk by chunk so memory is bounded by the number of movies rather than
+    the number of ratings.
+    """
+    counts = pd.Series(dtype=np.int64)
+    for chunk in pd.read_csv(path, usecols=['movieId', 'rating'], chunksize=chunk_size):
+        counts = pd.concat([counts, chunk.groupby('movieId').rating.count()]).groupby(level=0).sum()
+
+    counts.index.name = 'movieId'
+
+    return counts
+
+
+def _from_csv():
+    # Load from JSON
+    # actors = json.load(open(f'{DATA_PATH}/actors.json', 'r'))
+
+    # Load from CSV
+    movies = pd.read_csv(f'{ml_path}/movies.csv')
+    links = pd.read_csv(f'{ml_path}/links.csv')
+    mapping = pd.read_csv(f'{ml_path}/mapping.csv')
+    summaries = pd.read_csv(f'{ml_path}/summaries.csv')
+
+    # Get unique genres
+    genres_unique = pd.DataFrame(movies.genres.str.split('|').tolist()).stack().unique()
+    genres_unique = pd.DataFrame(genres_unique, columns=['genre'])
+    genres_unique = genres_unique[~genres_unique.genre.str.contains('no genres listed')]
+
+    # Split title and year
+    movies['year'] = movies.title.str.extract(r'\((\d{4})\)', expand=True)
+    movies.dropna(inplace=True)
+    movies.year = movies.year.astype(int)
+    movies.title = movies.title.str[:-7]
+    movies.genres = movies.genres.str.split('|').tolist()
+
+    movies.title = movies.title.map(transform_title)
+
+    # Add count to movies
+    dftmp = count_ratings(f'{ml_path}/ratings.csv').to_frame('numRatings')
+    movies = movies.merge(dftmp.dropna(), on='movieId')
+
+    # Remove movies with less than median ratings
+    movies = movies[movies['numRatings'].ge(int(dftmp.median()))]
+
+    # Get weights for sampling
+    movies['weight'] = movies['numRatings'] * [max(1, year - 2000) for year in movies['year']]
+
+    # Merge movies with links links
+    movies = movies.merge(links, on='movieId')
+
+    # Proper imdb ids
+    movies.imdbId = movies.imdbId.map(transform_imdb_id)
+
+    # Merge with mappings
+    movies = movies.merge(mapping, on='imdbId')
+
+    # Merge with summaries
+    movies = movies.merge(summaries, on='imdbId', how='left')
+
+    # Apply movieId as index
+    for df in [movies, links]:
+        df.sort_values(by='movieId', inplace=True)
+        df.reset_index(inplace=True, drop=True)
+
+    return movies, genres_unique, links
+
+
+def _read_links():
+    links = pd.read_csv(f'{ml_path}/links.csv')
+    links.sort_values(by='movieId', inplace=True)
+    links.reset_index(inplace=True, drop=True)
+
+    return links
+
+
+def _from_artifact():
+    """
+    Maps the catalog from the artifact, or returns None if it is missing or was built from other source files.
+    """
+    try:
+        catalog = MovieCatalog.open(ARTIFACT_PATH)
+        current, refreshed = _is_current(catalog.metadata.get('fingerprint'))
+        if not current:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if refreshed is not None:
+        try:
+            MovieCatalog.update_metadata(ARTIFACT_PATH, fingerprint=refreshed)
+        except OSError:
+            # A read-only artifact stays usable, its touched files are just hashed again on the next start
+            pass
+
+    return catalog
+
+
+def write_artifact(movies, genres_unique, path=ARTIFACT_PATH):
+    genres = {'genre': genres_unique.genre.tolist(), 'index': genres_unique.index.tolist()}
+    MovieCatalog.from_frame(movies).write(path, fingerprint=_source_fingerprint(), genres_unique=genres)
+
+
+def load():
+    """
+    Opens the catalog from the artifact, falling back to the CSV pipeline if it is missing or stale. Returns the
+    catalog and the tables computed on the way.
+    """
+    catalog = _from_artifact()
+    if catalog is not None:
+        return catalog, {}
+
+    movies, genres_unique, links = _from_csv()
+
+    return MovieCatalog.from_frame(movies), {'movies': movies, 'genres_unique': genres_unique, 'links': links}
+
+
+_state = {}
+_tables = {}
+_lock = threading.Lock()
+
+
+def warm():
+    """
+    Loads the catalog on first use, so importing this module is cheap.
+    """
+    with _lock:
+        if not _state:
+            catalog, tables = load()
+            _tables.update(tables)
+
+            _state['catalog'] = catalog
+            _state['from_artifact'] = not tables
+
+            # Weighted sampling over the movies, without copying the table per call
+            _state['sampler'] = WeightedSampler(catalog.column('weight'))
+
+    return _state
+
 
-# Load from CSV
-movies = pd.read_csv(f'{ml_path}/movies.csv')
-ratings = pd.read_csv(f'{ml_path}/ratings.csv')
-links = pd.read_csv(f'{ml_path}/links.csv')
-mapping = pd.read_csv(f'{ml_path}/mapping.csv')
-summaries = pd.read_csv(f'{ml_path}/summaries.csv')
+def get_catalog():
+    return warm()['catalog']
 
-# Get unique genres
-genres_unique = pd.DataFrame(movies.genres.str.split('|').tolist()).stack().unique()
-genres_unique = pd.DataFrame(genres_unique, columns=['genre'])
-genres_unique = genres_unique[~genres_unique.genre.str.contains('no genres listed')]
 
-# Split title and year
-movies['year'] = movies.title.str.extract(r'\((\d{4})\)', expand=True)
-movies.dropna(inplace=True)
-movies.year = movies.year.astype(int)
-movies.title = movies.title.str[:-7]
-movies.genres = movies.genres.str.split('|').tolist()
+def get_sampler():
+    return warm()['sampler']
 
-movies.title = movies.title.map(transform_title)
 
-# Add count to movies
-dftmp = ratings[['movieId', 'rating']].groupby('movieId').count()
-dftmp.columns = ['numRatings']
-movies = movies.merge(dftmp.dropna(), on='movieId')
+def _table(name):
+    # The tables are only materialized for offline scripts, the API reads the catalog
+    catalog = get_catalog()
+    with _lock:
+        if name not in _tables:
+            if name == 'movies':
+                _tables[name] = catalog.frame()
+            elif name == 'genres_unique':
+                genres = catalog.metadata['genres_unique']
+                _tables[name] = pd.DataFrame({'genre': genres['genre']}, index=genres['index'])
+            elif name == 'links':
+                _tables[name] = _read_links()
 
-# Remove movies with less than median ratings
-movies = movies[movies['numRatings'].ge(int(dftmp.median()))]
+        return _tables[name]
 
-# Get weights for sampling
-max_year = max(movies.year) + 1
-movies['weight'] = movies['numRatings'] * [max(1, year - 2000) for year in movies['year']]
 
-# Merge movies with links links
-movies = movies.merge(links, on='movieId')
+def __getattr__(name):
+    if name in ['catalog', 'sampler', 'from_artifact']:
+        return warm()[name]
 
-# Proper imdb ids
-movies.imdbId = movies.imdbId.map(transform_imdb_id)
+    if name in ['movies', 'genres_unique', 'links']:
+        return _table(name)
 
-# Merge with mappings
-movies = movies.merge(mapping, on='imdbId')
-movie_uris_set = set(movies.uri)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-# Merge with summaries
-movies = movies.merge(summaries, on='imdbId', how='left')
 
-# Apply movieId as index
-for df in [movies, ratings, links]:
-    df.sort_values(by='movieId', inplace=True)
-    df.reset_index(inplace=True, drop=True)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build'])
+    args = parser.parse_args()
 
-# Free ratings from memory
-del ratings, summaries
-gc.collect()
+    if args.command == 'build':
+        movies, genres_unique, _ = _from_csv()
+        write_artifact(movies, genres_unique)
+        print(f'Wrote {len(movies)} movies to {ARTIFACT_PATH}')
@@ -0,0 +1,151 @@
+import threading
+
+import numpy as np
+
+import dataset
+from configuration import GRAPH_CSV_PATH
+from local_graph import GRAPH_BACKEND, get_graph, node_uris
+
+
+class EntityIndex:
+    """
+    Dense int32 ids for the URIs of the graph's nodes and the catalog's movies, so that session state, seen sets and
+    exclusion checks hold integers instead of URI strings. Ids are internal to the process and URIs are only resolved
+    at the API and storage boundaries. Once built, the index only grows with the URIs graph queries return: any
+    other URI, such as one posted by a client, has no id and maps to -1.
+    """
+
+    def __init__(self, uris, ids, catalog):
+        """
+        Numbers the nodes as in uris, which ids maps back to positions, followed by the catalog's movies missing
+        from the graph. Both are held as given rather than copied, so they can be those of the LocalGraph.
+        """
+        self._node_uris = uris
+        self._node_ids = ids
+
+        catalog_uris = catalog.column('uri')[:].tolist()
+        self._other_uris = list(dict.fromkeys(uri for uri in catalog_uris if uri not in ids))
+        self._other_ids = {uri: len(uris) + i for i, uri in enumerate(self._other_uris)}
+        self._lock = threading.Lock()
+
+        self._index_catalog(self.ids(catalog_uris))
+
+    def __len__(self):
+        return len(self._node_uris) + len(self._other_uris)
+
+    def _id(self, uri):
+        entity_id = self._node_ids.get(uri)
+
+        return self._other_ids.get(uri, -1) if entity_id is None else entity_id
+
+    def ids(self, uris):
+        """
+        Returns the ids of a list of URIs as an int32 array, with -1 for URIs outside the index.
+        """
+        uris = list(uris)
+
+        return np.fromiter((self._id(uri) for uri in uris), dtype=np.int32, count=len(uris))
+
+    def intern(self, uris):
+        """
+        Returns the ids of a list of URIs as ids does, giving the next id to URIs outside the index. Only for URIs of
+        graph nodes, such as those returned by graph queries, which the index lacks when the graph CSVs are missing.
+        """
+        uris = list(uris)
+        missing = [uri for uri in uris if self._id(uri) < 0]
+
+        if missing:
+            with self._lock:
+                for uri in missing:
+                    if self._id(uri) < 0:
+                        # The URI is stored first, so any thread that finds the id can resolve it
+                        self._other_uris.append(uri)
+                        self._other_ids[uri] = len(self) - 1
+
+        return self.ids(uris)
+
+    def split(self, uris):
+        """
+        Returns the ids of the URIs in the index, and the list of the other URIs. Together they are the entity sets
+        that queries take as seeds and seen entities, as the graph may have nodes the index lacks.
+        """
+        uris = list(uris)
+        ids = self.ids(uris)
+
+        return ids[ids >= 0], [uri for uri, entity_id in zip(uris, ids.tolist()) if entity_id < 0]
+
+    def id(self, uri):
+        return self._id(uri)
+
+    def uris(self, ids):
+        return [self.uri(i) for i in np.asarray(ids, dtype=np.int64).tolist()]
+
+    def uri(self, entity_id):
+        nodes = len(self._node_uris)
+
+        return self._node_uris[entity_id] if entity_id < nodes else self._other_uris[entity_id - nodes]
+
+    def _index_catalog(self, ids):
+        """
+        Maps every id to the first catalog row of its URI, as catalog lookups do. Ids of URIs on several rows also
+        keep their other rows, so that all of them can be excluded.
+        """
+        order = np.argsort(ids, kind='stable')
+        unique, first, counts = np.unique(ids[order], return_index=True, return_counts=True)
+
+        positions = np.full(len(self), -1, dtype=np.int64)
+        positions[unique] = order[first]
+        self._movie_positions = positions
+
+        duplicated = counts > 1
+        self._other_rows = {entity_id: order[start + 1:start + count] for entity_id, start, count in
+                            zip(*[values[duplicated].tolist() for values in (unique, first, counts)])}
+
+    def movie_positions(self, ids):
+        """
+        Returns the catalog row position of every id, or -1 for entities that are not movies and negative ids.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.full(len(ids), -1, dtype=np.int64)
+
+        # Ids given after the catalog was indexed are not movies
+        known = (ids >= 0) & (ids < len(self._movie_positions))
+        positions[known] = self._movie_positions[ids[known]]
+
+        return positions
+
+    def movie_rows(self, ids):
+        """
+        Returns every catalog row of the movies among ids, such as to exclude them from samples.
+        """
+        positions = self.movie_positions(ids)
+        rows = [positions[positions >= 0]]
+        if self._other_rows:
+            rows += [self._other_rows[entity_id] for entity_id in set(np.asarray(ids).tolist())
+                     if entity_id in self._other_rows]
+
+        return np.concatenate(rows)
+
+
+_state = {}
+_lock = threading.Lock()
+
+
+def get_entity_index():
+    """
+    Returns the entity index, building it on first use from the graph's nodes and the movie catalog. With the memory
+    backend, the index shares the URIs of the LocalGraph, and otherwise reads them from the graph CSVs in the same
+    order, so the id of a node is its position in the local graph either way.
+    """
+    with _lock:
+        if 'index' not in _state:
+            if GRAPH_BACKEND == 'memory':
+                graph = get_graph()
+                uris, ids = graph.uris, graph.index
+            else:
+                uris = list(dict.fromkeys(node_uris(GRAPH_CSV_PATH)))
+                ids = {uri: position for position, uri in enumerate(uris)}
+
+            _state['index'] = EntityIndex(uris, ids, dataset.get_catalog())
+
+    return _state['index']
@@ -0,0 +1,241 @@
+import csv
+import glob
+import io
+import os
+import threading
+import time
+import zlib
+from array import array
+from os import environ
+
+import numpy as np
+
+from catalog import StringColumn
+from configuration import EXPORT_PATH, FINGERPRINT_INTERVAL, EXPORT_LOCK_TIMEOUT
+from queries import get_graph_version
+
+
+def csv_chunks(header, chunks):
+    """
+    Renders chunks of rows as CSV, yielding the text of one chunk at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    writer.writerow(header)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def gzip_chunks(chunks):
+    """
+    Compresses text chunks into a single gzip stream, yielding compressed bytes as they become available.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def indexed_rows(rows, chunk_size=10000):
+    """
+    Groups rows into chunks, prefixing every row with its index as DataFrame.to_csv does.
+    """
+    chunk = []
+    for index, row in enumerate(rows):
+        chunk.append([index, *row])
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def rating_columns(rows):
+    """
+    Encodes (userId, uri, isItem, sentiment) rows as a compressed .npz of columns, readable with numpy.load:
+
+    - user, uri: int32 codes into the users and uris dictionaries
+    - sentiment: int8
+    - users_data, users_offsets, uris_data, uris_offsets: the dictionaries, as UTF-8 buffers and the offsets of
+      every string, so the i-th URI is uris_data[uris_offsets[i]:uris_offsets[i + 1]]
+    - uris_is_item: whether every URI in the dictionary is a movie
+    - changed: int32 codes of the users whose previous ratings these replace, from rows with an empty uri
+
+    Unlike the CSV formats, this is not streamed: a zip archive of numpy arrays cannot be written before every row
+    is known, so the archive is built in memory and sent as a whole. Only the compact codes and dictionaries are
+    held while the rows are read.
+    """
+    dictionaries = {'users': {}, 'uris': {}}
+    codes = {'users': array('i'), 'uris': array('i')}
+    sentiments = array('b')
+    changed = array('i')
+    is_item = {}
+
+    for user, uri, item, sentiment in rows:
+        if not uri:
+            changed.append(dictionaries['users'].setdefault(user, len(dictionaries['users'])))
+            continue
+
+        for name, value in [('users', user), ('uris', uri)]:
+            codes[name].append(dictionaries[name].setdefault(value, len(dictionaries[name])))
+
+        is_item[uri] = item
+        sentiments.append(sentiment)
+
+    columns = {
+        'user': np.frombuffer(codes['users'], dtype=np.int32),
+        'uri': np.frombuffer(codes['uris'], dtype=np.int32),
+        'sentiment': np.frombuffer(sentiments, dtype=np.int8),
+        'uris_is_item': np.array([is_item[uri] for uri in dictionaries['uris']], dtype=bool),
+        'changed': np.frombuffer(changed, dtype=np.int32)
+    }
+
+    for name, dictionary in dictionaries.items():
+        strings = StringColumn.from_values(list(dictionary))
+        columns[f'{name}_data'] = strings.data
+        columns[f'{name}_offsets'] = strings.offsets
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **columns)
+
+    return buffer.getvalue()
+
+
+def triple_rows(chunks):
+    index = 0
+    for chunk in chunks:
+        yield [[index + offset, record['head_uri'], record['relation'], record['tail_uri']]
+               for offset, record in enumerate(chunk)]
+        index += len(chunk)
+
+
+def entity_rows(chunks):
+    for chunk in chunks:
+        yield [[record['uri'], record['name'], '|'.join(record['labels'])] for record in chunk]
+
+
+def _compute_fingerprint():
+    # An explicit graph version takes precedence over the one of the graph itself
+    return environ.get('GRAPH_VERSION') or get_graph_version()
+
+
+_fingerprint = {'value': None, 'time': 0}
+
+
+def graph_fingerprint():
+    if time.time() - _fingerprint['time'] >= FINGERPRINT_INTERVAL:
+        _fingerprint['value'] = _compute_fingerprint()
+        _fingerprint['time'] = time.time()
+
+    return _fingerprint['value']
+
+
+class ExportCache:
+    """
+    Keeps the rendered CSV export of the graph on disk, one file per graph fingerprint. When the fingerprint
+    changes, the export is rebuilt in a background thread and older files are removed. A lock file next to the
+    export ensures that a single worker of all those sharing the directory builds it.
+    """
+
+    def __init__(self, name, header, rows, path=EXPORT_PATH):
+        self.name = name
+        self.header = header
+        self.rows = rows
+        self.path = path
+
+    def file(self, fingerprint):
+        return os.path.join(self.path, f'{self.name}-{fingerprint}.csv')
+
+    def chunks(self):
+        return csv_chunks(self.header, self.rows())
+
+    def get(self):
+        """
+        Returns an open binary file and the fingerprint of the current export, or None while it is being built or
+        if the graph has no version to cache it by. The file stays readable if another worker removes it in the
+        meantime.
+        """
+        fingerprint = graph_fingerprint()
+        if fingerprint is None:
+            return None
+
+        try:
+            return open(self.file(fingerprint), 'rb'), fingerprint
+        except FileNotFoundError:
+            pass
+
+        if self._lock(fingerprint):
+            threading.Thread(target=self.build, args=(fingerprint,), daemon=True).start()
+
+        return None
+
+    def _lock(self, fingerprint):
+        """
+        Takes the build lock of an export, taking over locks left by workers that died while building.
+        """
+        lock = f'{self.file(fingerprint)}.lock'
+        os.makedirs(self.path, exist_ok=True)
+
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock) < EXPORT_LOCK_TIMEOUT:
+                        return False
+
+                    os.remove(lock)
+                except FileNotFoundError:
+                    # Released in the meantime
+                    pass
+
+        return False
+
+    def build(self, fingerprint):
+        file = self.file(fingerprint)
+        lock = f'{file}.lock'
+        temporary = f'{file}.{os.getpid()}.tmp'
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+
+            touched = time.time()
+            with open(temporary, 'w') as fp:
+                for chunk in self.chunks():
+                    fp.write(chunk)
+
+                    # Keeps the lock from looking abandoned during long builds
+                    if time.time() - touched > EXPORT_LOCK_TIMEOUT / 4:
+                        os.utime(lock)
+                        touched = time.time()
+
+            os.replace(temporary, file)
+
+            for other in glob.glob(os.path.join(self.path, f'{self.name}-*.csv')):
+                if other != file:
+                    # Another worker may have cleaned up the same file
+                    try:
+                        os.remove(other)
+                    except FileNotFoundError:
+                        pass
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,195 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from configuration import LIKED, DISLIKED, UNKNOWN
+
+# Chance that a simulated user likes, dislikes or does not know an entity shown to them
+CHOICES = [(LIKED, 0.25), (DISLIKED, 0.15), (UNKNOWN, 0.6)]
+
+# Feedback pages after which a session is abandoned, should the questions never run out
+MAX_PAGES = 50
+
+# How long (in seconds) to wait for the app to warm up before starting
+READY_TIMEOUT = 300
+
+
+class InProcessClient:
+    """
+    Calls the app through Flask's test client, so requests cost what the app costs and nothing more.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, token, body=None):
+        response = self.client.open(path, method=method, headers={'Authorization': token}, json=body)
+
+        return response.status_code, response.get_json(silent=True)
+
+    def ready(self):
+        return self.client.get('/api/ready').status_code == 200
+
+
+class HttpClient:
+    def __init__(self, url):
+        import requests
+
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, token, body=None):
+        response = self.session.request(method, f'{self.url}{path}', headers={'Authorization': token}, json=body,
+                                        timeout=60)
+
+        return response.status_code, response.json() if response.ok else None
+
+    def ready(self):
+        try:
+            return self.session.get(f'{self.url}/api/ready', timeout=5).status_code == 200
+        except IOError:
+            return False
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sessions = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def finish_session(self):
+        with self._lock:
+            self.sessions += 1
+
+    def report(self, elapsed):
+        lines = [f'{self.sessions} sessions in {elapsed:.1f}s ({self.sessions / elapsed:.2f} sessions/s)',
+                 f'{"endpoint":<24}{"requests":>10}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}'
+                 f'{"p99 ms":>10}']
+
+        for endpoint, latencies in self.latencies.items():
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            lines.append(f'{endpoint:<24}{len(latencies):>10}{self.errors[endpoint]:>8}'
+                         f'{len(latencies) / elapsed:>10.1f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}')
+
+        return '\n'.join(lines)
+
+
+def _timed(client, results, method, path, token, body=None):
+    started = time.perf_counter()
+    status, data = client.request(method, path, token, body)
+    results.record(f'{method} {path}', time.perf_counter() - started, status == 200)
+
+    return data if status == 200 else None
+
+
+def _choose(entities, rng):
+    feedback = {LIKED: [], DISLIKED: [], UNKNOWN: []}
+    categories, weights = zip(*CHOICES)
+
+    for entity in entities:
+        feedback[rng.choices(categories, weights)[0]].append(entity['uri'])
+
+    return feedback
+
+
+def simulate_user(client, results, sessions, rng):
+    """
+    Runs sessions of a single user: movies, feedback until predictions are shown, recommendations and final.
+    """
+    head = uuid.UUID(int=rng.getrandbits(128)).hex
+
+    for _ in range(sessions):
+        token = f'{head}+{uuid.UUID(int=rng.getrandbits(128)).hex}'
+
+        page = _timed(client, results, 'GET', '/api/movies', token)
+        for _ in range(MAX_PAGES):
+            if not isinstance(page, list):
+                break
+
+            page = _timed(client, results, 'POST', '/api/feedback', token, _choose(page, rng))
+
+        if not isinstance(page, dict):
+            continue
+
+        _timed(client, results, 'GET', '/api/recommendations', token)
+
+        final = _choose(page['likes'] + page['dislikes'], rng)
+        _timed(client, results, 'POST', '/api/final', token, final)
+
+        results.finish_session()
+
+
+def _in_process_app(backend, storage):
+    # Read when the app is imported
+    os.environ['GRAPH_BACKEND'] = backend
+    os.environ['SESSION_STORAGE'] = storage
+
+    import mindreader
+
+    return mindreader.app
+
+
+def run(make_client, users, concurrency, sessions, seed):
+    results = Results()
+
+    deadline = time.time() + READY_TIMEOUT
+    while not make_client().ready():
+        if time.time() > deadline:
+            raise TimeoutError('The app did not become ready')
+
+        time.sleep(1)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(simulate_user, make_client(), results, sessions, random.Random(seed + user))
+                   for user in range(users)]
+
+        for future in futures:
+            future.result()
+
+    return results, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates concurrent users going through full sessions')
+    parser.add_argument('--url', help='Base URL of a running app, which is otherwise run in-process')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions per user')
+    parser.add_argument('--graph', choices=['memory', 'neo4j'], default='memory',
+                        help='Graph backend of the in-process app, memory answers queries from the graph CSVs')
+    parser.add_argument('--session-storage', help='Where the in-process app stores sessions, a temporary '
+                                                  'directory by default')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        storage = args.session_storage or tempfile.mkdtemp(prefix='loadtest-')
+        if not args.session_storage and os.environ.get('SESSION_BACKEND') == 'sqlite':
+            storage = os.path.join(storage, 'sessions.db')
+
+        app = _in_process_app(args.graph, storage)
+
+        def make_client():
+            return InProcessClient(app)
+
+    results, elapsed = run(make_client, args.users, args.concurrency, args.sessions, args.seed)
+    print(results.report(elapsed))
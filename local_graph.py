@@ -0,0 +1,279 @@
+import csv
+import hashlib
+import os
+import warnings
+from os import environ
+
+import numpy as np
+from scipy import sparse
+
+from configuration import GRAPH_CSV_PATH
+
+# Either neo4j, or memory to answer every query in-process from the import CSVs. CANDIDATE_ENGINE=local is the
+# older name of the latter
+GRAPH_BACKEND = environ.get('GRAPH_BACKEND', 'memory' if environ.get('CANDIDATE_ENGINE') == 'local' else 'neo4j')
+
+NODE_FILES = ['movies.csv', 'people.csv', 'categories.csv', 'companies.csv', 'decades.csv']
+EDGE_FILES = ['movie_genre.csv', 'movie_director.csv', 'movie_actor.csv', 'movie_subject.csv', 'movie_decade.csv',
+              'movie_company.csv', 'movie_sequel.csv', 'subclasses.csv']
+
+# Labels given to the end node of a relationship, on top of the label from its node file
+RELATION_LABELS = {
+    'HAS_GENRE': 'Genre',
+    'HAS_SUBJECT': 'Subject',
+    'DIRECTED_BY': 'Director',
+    'STARRING': 'Actor'
+}
+
+# Labels of the end nodes of relationships that are created when the node files lack them. Only people are, as the
+# wikidata dump writes these relationships for people alone, while their node file may not be shipped
+ENDPOINT_LABELS = {
+    'DIRECTED_BY': 'Person',
+    'STARRING': 'Person'
+}
+
+LABELS = ['Movie', 'Person', 'Category', 'Company', 'Decade', 'Genre', 'Subject', 'Director', 'Actor']
+
+# Personalized PageRank, as approximated by the particlefiltering procedure
+DAMPING = 0.85
+ITERATIONS = 20
+
+
+def _read(path, file):
+    file = os.path.join(path, file)
+    if not os.path.exists(file):
+        warnings.warn(f'Graph file {file} is missing, the graph lacks its nodes or relationships')
+        return []
+
+    with open(file, 'r') as fp:
+        return list(csv.DictReader(fp))
+
+
+def files_version(path):
+    """
+    Hash of the contents of the graph files present, identifying the graph built from them.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for file in NODE_FILES + EDGE_FILES:
+        file = os.path.join(path, file)
+        if not os.path.exists(file):
+            continue
+
+        digest.update(os.path.basename(file).encode('utf-8'))
+        with open(file, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _node_rows(path):
+    """
+    Yields the rows of the node files, followed by a row for every end node of the relationships in ENDPOINT_LABELS
+    that they lack.
+    """
+    uris = set()
+    for file in NODE_FILES:
+        for row in _read(path, file):
+            uris.add(row['uri:ID'])
+            yield row
+
+    for file in EDGE_FILES:
+        for row in _read(path, file):
+            uri, label = row[':END_ID'], ENDPOINT_LABELS.get(row[':TYPE'])
+            if label is not None and uri not in uris:
+                uris.add(uri)
+                yield {'uri:ID': uri, ':LABEL': label}
+
+
+def node_uris(path=GRAPH_CSV_PATH):
+    """
+    Yields the URI of every node, in the order LocalGraph numbers them.
+    """
+    for row in _node_rows(path):
+        yield row['uri:ID']
+
+
+class LocalGraph:
+    """
+    The knowledge graph loaded from the import CSVs into a sparse adjacency matrix, scoring candidates with
+    personalized PageRank in-process. Backs every query in queries.py when GRAPH_BACKEND is memory, with records
+    of the same shape. Nodes are numbered in the order of node_uris, so their positions are their entity ids.
+    """
+
+    def __init__(self, path=GRAPH_CSV_PATH):
+        # Hashed before reading, so files replaced meanwhile give a new version at the next load rather than none
+        self.version = files_version(path)
+        self.uris = []
+        self.index = {}
+        self.properties = []
+        self.labels = []
+
+        for row in _node_rows(path):
+            self._add_node(row)
+
+        heads, tails, types = [], [], []
+        for file in EDGE_FILES:
+            for row in _read(path, file):
+                head, tail = self.index.get(row[':START_ID']), self.index.get(row[':END_ID'])
+
+                # Other relationships to nodes missing from the node files are skipped, as by the Neo4j import
+                if head is None or tail is None:
+                    continue
+
+                heads.append(head)
+                tails.append(tail)
+                types.append(row[':TYPE'])
+
+                if row[':TYPE'] in RELATION_LABELS:
+                    self.labels[tail].add(RELATION_LABELS[row[':TYPE']])
+
+        n = len(self.uris)
+        self.heads = np.asarray(heads, dtype=np.int64)
+        self.tails = np.asarray(tails, dtype=np.int64)
+        self.types = types
+        self.label_matrix = np.asarray([[label in labels for label in LABELS] for labels in self.labels],
+                                       dtype=bool).reshape(n, len(LABELS))
+        self.is_movie = self.label_matrix[:, LABELS.index('Movie')]
+        self.weights = np.asarray([float(properties.get('weight') or 0) for properties in self.properties])
+
+        # Directed edges, used to find the movies related to an entity
+        self.directed = sparse.csc_matrix((np.ones(len(heads)), (self.heads, self.tails)), shape=(n, n))
+
+        # Random walks follow relationships in both directions
+        adjacency = (self.directed + self.directed.T).tocsr()
+        degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+        inverse = np.divide(1.0, degrees, out=np.zeros(n), where=degrees > 0)
+        self.transition = adjacency.T.multiply(inverse).tocsr()
+
+        self._movies = {}
+
+    def _add_node(self, row):
+        uri = row['uri:ID']
+        if uri in self.index:
+            return
+
+        self.index[uri] = len(self.uris)
+        self.uris.append(uri)
+        self.labels.append({row[':LABEL']})
+        self.properties.append({
+            'name': row.get('name') or None,
+            'imdb': row.get('imdb') or None,
+            'image': row.get('image') or None,
+            'year': int(row['year:int']) if row.get('year:int') else None,
+            'weight': float(row['weight:float']) if row.get('weight:float') else None
+        })
+
+    def __len__(self):
+        return len(self.uris)
+
+    def stats(self):
+        return {'nodes': len(self.uris), 'relationships': len(self.heads)}
+
+    def entities(self):
+        """
+        Yields every node as the entities query does, with labels in LABELS order.
+        """
+        for position, uri in enumerate(self.uris):
+            yield {'uri': uri, 'name': self.properties[position]['name'],
+                   'labels': [label for label in LABELS if label in self.labels[position]]}
+
+    def triples(self):
+        for head, relation, tail in zip(self.heads.tolist(), self.types, self.tails.tolist()):
+            yield {'head_uri': self.uris[head], 'relation': relation, 'tail_uri': self.uris[tail]}
+
+    def counts(self, labels=('Person', 'Category', 'Decade', 'Company', 'Movie')):
+        # Number of nodes per label, as apoc.meta.stats
+        return {label: int(self.label_matrix[:, LABELS.index(label)].sum()) for label in labels}
+
+    def nodes(self, ids):
+        """
+        Positions of the entity ids that are nodes of the graph.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+
+        return ids[ids < len(self.uris)]
+
+    def scores(self, sources):
+        """
+        Personalized PageRank of every node, restarting at the source positions.
+        """
+        restart = np.zeros(len(self.uris))
+        if not len(sources):
+            return restart
+
+        restart[sources] = 1.0 / len(sources)
+        scores = restart.copy()
+        for _ in range(ITERATIONS):
+            scores = (1 - DAMPING) * restart + DAMPING * self.transition.dot(scores)
+
+        return scores
+
+    def _candidates(self, sources, seen):
+        scores = self.scores(sources)
+        candidates = scores > 0
+        candidates[seen] = False
+
+        return scores, np.flatnonzero(candidates)
+
+    def related_movies(self, position, n=5):
+        # Movies with a relationship to the entity, by descending weight
+        if position not in self._movies:
+            column = self.directed.indices[self.directed.indptr[position]:self.directed.indptr[position + 1]]
+            movies = column[self.is_movie[column]]
+            self._movies[position] = movies[np.argsort(-self.weights[movies], kind='stable')][:n]
+
+        return self._movies[position]
+
+    def record(self, position, score):
+        labels = dict(zip(LABELS, self.label_matrix[position]))
+        properties = self.properties[position]
+        movies = [] if labels['Movie'] else [{'uri': self.uris[movie]} for movie in self.related_movies(position)]
+
+        return {
+            'director': labels['Director'], 'actor': labels['Actor'], 'imdb': properties['imdb'],
+            'subject': labels['Subject'], 'movie': labels['Movie'], 'company': labels['Company'],
+            'decade': labels['Decade'], 'uri': self.uris[position], 'name': properties['name'],
+            'genre': labels['Genre'], 'person': labels['Person'], 'category': labels['Category'],
+            'image': properties['image'], 'year': properties['year'], 'movies': movies, 'score': float(score)
+        }
+
+    def last_batch(self, sources, seen, limit):
+        scores, candidates = self._candidates(sources, seen)
+        movies = candidates[self.is_movie[candidates]]
+        top = movies[np.argsort(-scores[movies], kind='stable')][:limit]
+
+        return [{'uri': self.uris[position], 'score': float(scores[position])} for position in top]
+
+    def relevant_neighbors(self, sources, seen, k):
+        """
+        The top k candidates of every combination of labels, as get_relevant_neighbors.
+        """
+        scores, candidates = self._candidates(sources, seen)
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        if not len(candidates):
+            return []
+
+        # Rank of every candidate within its combination of labels, which keeps the descending score order
+        _, groups = np.unique(self.label_matrix[candidates], axis=0, return_inverse=True)
+        order = np.argsort(groups.ravel(), kind='stable')
+        grouped = groups.ravel()[order]
+        ranks = np.arange(len(order)) - np.searchsorted(grouped, grouped)
+
+        top = np.sort(order[ranks < k])
+
+        return [self.record(position, scores[position]) for position in candidates[top]]
+
+
+_graph = {}
+
+
+def get_graph():
+    """
+    Returns the graph, loading it on first use.
+    """
+    if 'graph' not in _graph:
+        _graph['graph'] = LocalGraph()
+
+    return _graph['graph']
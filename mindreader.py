@@ -1,43 +1,87 @@
-import glob
-import json
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor, wait
-from functools import reduce
 from random import shuffle
 
-from flask import Flask, jsonify, request, abort, make_response
+import numpy as np
+from flask import Flask, jsonify, request, abort, Response, stream_with_context, g
 from flask_cors import CORS
-from pandas import DataFrame
 
 import dataset
+from exports import ExportCache, triple_rows, entity_rows, csv_chunks, gzip_chunks, indexed_rows, \
+    rating_columns
 from configuration import *
-from queries import get_relevant_neighbors, get_last_batch, get_triples, get_entities
-from sampling import sample_relevant_neighbours, record_to_entity, _movie_from_uri
-from statistics import compute_statistics
+from entities import get_entity_index
+from queries import get_relevant_neighbors_batch, get_last_batches, iter_triples, iter_entities
+from sampling import sample_relevant_neighbours, record_to_entity, _movies_from_uris, entity_counts
+from session_backend import get_backend, load_in_process
+from session_store import SessionStore
+from statistics import compute_statistics, record_interaction, uri_names
 from utility.encoder import NpEncoder
-from utility.utilities import get_ratings_dataframe
+from utility.journal import make_record, last_sequence
+from utility.metrics import REGISTRY
+from utility.scheduler import QueryScheduler
+from utility.warmup import Warmup
+from utility.utilities import iter_user_entity_pairs, ratings_cursor, changed_users, RATING_COLUMNS
 
 app = Flask(__name__)
 app.json_encoder = NpEncoder
-cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
+cors = CORS(app, resources={r"/api/*": {"origins": "*", "expose_headers": ["X-Ratings-Cursor"]}})
 
-# Maintains all relevant sessions
-SESSION = {}
+# Maintains all relevant sessions, grouped by head (user token)
+STORE = SessionStore(get_backend())
 
-# Maintains a set of heads (user tokens) that have been loaded from files
-LOADED_HEADS = set()
+# Runs the graph queries of all requests, so a slow query only delays the page that issued it
+SCHEDULER = QueryScheduler(QUERY_WORKERS, QUERY_QUEUE_SIZE)
 
-if not os.path.exists(SESSION_PATH):
-    os.mkdir(SESSION_PATH)
+# Everything slow to load is loaded in the background, requests arriving before then load what they need themselves
+WARMUP = Warmup({
+    'catalog': dataset.warm,
+    'entity_index': get_entity_index,
+    'entity_counts': entity_counts,
+    'uri_names': uri_names
+}, WARMUP_RETRY_INTERVAL)
+WARMUP.start()
+
+REQUEST_DURATION = REGISTRY.histogram('mindreader_request_duration_seconds',
+                                      'Duration of API requests, by endpoint, method and status')
+STAGE_DURATION = REGISTRY.histogram('mindreader_stage_duration_seconds', 'Duration of the stages of a request')
+SAMPLE_SIZE = REGISTRY.histogram('mindreader_sample_size', 'Entities sampled per call, by source',
+                                 buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+SESSION_WRITE_BYTES = REGISTRY.counter('mindreader_session_write_bytes_total', 'Bytes written to session storage')
+REGISTRY.gauge('mindreader_scheduler_pending', 'Graph queries waiting for a thread', lambda: SCHEDULER.pending)
+REGISTRY.gauge('mindreader_scheduler_running', 'Graph queries running', lambda: SCHEDULER.running)
+REGISTRY.gauge('mindreader_scheduler_fallbacks_total', 'Graph queries that fell back, by reason',
+               lambda: {(('reason', 'timeout'),): SCHEDULER.timeouts, (('reason', 'rejected'),): SCHEDULER.rejected},
+               kind='counter')
+REGISTRY.gauge('mindreader_session_manifest_errors_total', 'Failed writes to the manifest of the session directory',
+               lambda: getattr(STORE.backend, 'manifest', None) and STORE.backend.manifest.errors, kind='counter')
+REGISTRY.gauge('mindreader_ready', 'Whether the worker has finished warming up', lambda: int(WARMUP.ready()))
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+    if 'started' in g:
+        REQUEST_DURATION.observe(time.perf_counter() - g.started, endpoint=request.endpoint or 'unknown',
+                                 method=request.method, status=response.status_code)
+
+    return response
 
 
 def _get_samples(amount):
-    liked, disliked, unknown, seen_entities = get_cross_session_entities()
-    samples = dataset.sample(amount, seen_entities)
-    update_session([], [], [], list(samples.uri))
+    liked, disliked, unknown, (seen_ids, _) = get_cross_session_entities()
+    with STAGE_DURATION.time(stage='sample'):
+        # Every catalog movie is in the entity index, so the seen URIs outside it are not movies
+        samples = dataset.sample(amount, get_entity_index().movie_rows(seen_ids))
 
-    return [_get_movie_from_row(row) for index, row in samples.iterrows()]
+    SAMPLE_SIZE.observe(len(samples), source='popularity')
+    update_session([], [], [], [row['uri'] for row in samples])
+
+    return [_get_movie_from_row(row) for row in samples]
 
 
 def _get_movie_from_row(row):
@@ -52,9 +96,34 @@ def _get_movie_from_row(row):
     return res
 
 
+@app.route('/api/health')
+def health():
+    WARMUP.start()
+
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/api/ready')
+def ready():
+    WARMUP.start()
+    report = WARMUP.report()
+
+    return jsonify(report), 200 if report['ready'] else 503
+
+
+@app.route('/api/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/sessions')
 def sessions():
-    return jsonify(len(glob.glob(os.path.join(SESSION_PATH, '*.json'))))
+    return jsonify(STORE.backend.count())
+
+
+@app.route('/api/scheduler')
+def scheduler():
+    return jsonify(SCHEDULER.statistics())
 
 
 @app.route('/api/statistics')
@@ -67,12 +136,11 @@ def statistics():
 
 
 def _get_recommendations(liked, disliked, seen_entities):
-    parallel = list()
-
-    parallel.append([get_last_batch, liked, seen_entities])
-    parallel.append([get_last_batch, disliked, seen_entities])
-
-    liked_res, disliked_res = get_next_entities(parallel)
+    # Both seed sets are scored in a single round trip, falling back to only random samples if it is too slow
+    with STAGE_DURATION.time(stage='graph'):
+        batches = SCHEDULER.run(get_last_batches, {LIKED: (liked, 10), DISLIKED: (disliked, 10)}, seen_entities,
+                                timeout=QUERY_DEADLINE, fallback=lambda: {LIKED: [], DISLIKED: []})
+    liked_res, disliked_res = batches[LIKED], batches[DISLIKED]
 
     for uri in set([item['uri'] for item in liked_res]).intersection(set([item['uri'] for item in disliked_res])):
         liked_res = list(filter(lambda u: u['uri'] != uri, liked_res))
@@ -88,8 +156,8 @@ def _get_recommendations(liked, disliked, seen_entities):
         samples = list(filter(lambda m: m['uri'] != uri, samples))
 
     # Get rows from movies
-    liked_res = [_get_movie_from_row(_movie_from_uri(uri)) for uri in liked_res]
-    disliked_res = [_get_movie_from_row(_movie_from_uri(uri)) for uri in disliked_res]
+    liked_res = [_get_movie_from_row(movie) for movie in _movies_from_uris(liked_res) if movie]
+    disliked_res = [_get_movie_from_row(movie) for movie in _movies_from_uris(disliked_res) if movie]
 
     # Add random samples to liked and disliked (from different directions.
     liked_res = liked_res + samples[:LAST_N_QUESTIONS - len(liked_res)]
@@ -125,29 +193,17 @@ def movies():
     return jsonify(_get_samples(10))
 
 
-def _get_movie_uris():
-    return set(dataset.movies.uri)
-
-
 def _has_both_sentiments():
-    movie_uris = _get_movie_uris()
+    entities = get_entity_index()
 
-    return set(get_liked_entities()).difference(movie_uris) and set(get_disliked_entities()).difference(movie_uris)
+    return (entities.movie_positions(get_liked_entities()) < 0).any() and \
+        (entities.movie_positions(get_disliked_entities()) < 0).any()
 
 
 def is_done():
     return len(get_current_session_entities()) >= MIN_QUESTIONS
 
 
-def _make_csv(csv, file_name):
-    output = make_response(csv)
-
-    output.headers['Content-Disposition'] = f'attachment; filename={file_name}'
-    output.headers['Content-Type'] = 'text/csv'
-
-    return output
-
-
 @app.route('/api/ratings', methods=['GET'])
 def get_ratings():
     final_only = request.args.get('final')
@@ -157,32 +213,80 @@ def get_ratings():
     if versions:
         versions = versions.split(',')
 
-    df = get_ratings_dataframe(final_only, versions)
+    # With a cursor from a previous response, only users whose sessions changed since are returned, preceded by a row
+    # with an empty uri per user telling clients to drop its previous ratings
+    since = request.args.get('since')
+    if since:
+        try:
+            users, cursor = changed_users(float(since))
+        except ValueError:
+            return abort(400)
+    else:
+        users, cursor = None, ratings_cursor()
+
+    rows = iter_user_entity_pairs(final_only, versions, users)
+    output_format = request.args.get('format', 'csv')
+    headers = {'X-Ratings-Cursor': str(cursor)}
+
+    if output_format == 'csv':
+        return _stream_csv(csv_chunks([''] + RATING_COLUMNS, indexed_rows(rows)), 'ratings.csv', headers)
+    elif output_format == 'csv.gz':
+        chunks = gzip_chunks(csv_chunks([''] + RATING_COLUMNS, indexed_rows(rows)))
+        return _stream_file(chunks, 'ratings.csv.gz', 'application/gzip', headers)
+    elif output_format == 'npz':
+        # Built in memory and sent at once, see rating_columns
+        return _stream_file([rating_columns(rows)], 'ratings.npz', 'application/octet-stream', headers)
+
+    return abort(400)
+
+
+def _stream_file(chunks, file_name, mimetype, headers=None):
+    output = Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
-    return _make_csv(df.to_csv(), 'ratings.csv')
+    output.headers['Content-Disposition'] = f'attachment; filename={file_name}'
+
+    return output
+
+
+def _stream_csv(chunks, file_name, headers=None):
+    return _stream_file(chunks, file_name, 'text/csv', headers)
+
+
+def _read_file(fp, chunk_size=1 << 16):
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        yield chunk
+
+
+def _export_csv(export, file_name):
+    current = export.get()
+
+    # Stream from the graph while the export for the current graph is being built, or if it has no version
+    if not current:
+        return _stream_csv(export.chunks(), file_name)
+
+    fp, fingerprint = current
+    output = Response(_read_file(fp), mimetype='text/csv')
+    output.call_on_close(fp.close)
+
+    output.headers['Content-Disposition'] = f'attachment; filename={file_name}'
+    output.headers['Content-Length'] = os.fstat(fp.fileno()).st_size
+    output.set_etag(fingerprint)
+
+    return output.make_conditional(request)
+
+
+TRIPLES_EXPORT = ExportCache('triples', ['', 'head_uri', 'relation', 'tail_uri'], lambda: triple_rows(iter_triples()))
+ENTITIES_EXPORT = ExportCache('entities', ['uri', 'name', 'labels'], lambda: entity_rows(iter_entities()))
 
 
 @app.route('/api/triples', methods=['GET'])
 def get_all_triples():
-    data = get_triples()
-    df = DataFrame.from_records(data)
-    if data:
-        df.columns = data[0].keys()
-
-    return _make_csv(df.to_csv(), 'triples.csv')
+    return _export_csv(TRIPLES_EXPORT, 'triples.csv')
 
 
 @app.route('/api/entities', methods=['GET'])
 def get_all_entities():
-    data = get_entities()
-    df = DataFrame.from_records(data)
-    if data:
-        df.columns = data[0].keys()
-    
-    df.set_index('uri', inplace=True)
-    df['labels'] = df['labels'].str.join('|')
-
-    return _make_csv(df.to_csv(), 'entities.csv')
+    return _export_csv(ENTITIES_EXPORT, 'entities.csv')
 
 
 @app.route('/api/final', methods=['POST'])
@@ -208,22 +312,23 @@ def feedback():
     if is_done():
         return jsonify(_get_recommendations(liked, disliked, seen_entities))
 
-    parallel = []
+    groups = {}
     num_rand = N_ENTITIES
 
     extra = 0
     if bool(json_data[LIKED]) != bool(json_data[DISLIKED]):
         extra = N_ENTITIES // 2
 
+    # Entities are given by URI, and referred to by id from here on, but for those outside the entity index
+    entities = get_entity_index()
+
     if json_data[LIKED]:
-        parallel.append([get_related_entities, list(json_data[LIKED]), seen_entities,
-                         (N_ENTITIES + extra) if extra else None])
+        groups[LIKED] = (entities.split(json_data[LIKED]), (N_ENTITIES + extra) if extra else None)
     else:
         num_rand += (N_ENTITIES - (N_ENTITIES // 2)) if extra else N_ENTITIES
 
     if json_data[DISLIKED]:
-        parallel.append([get_related_entities, list(json_data[DISLIKED]), seen_entities,
-                         (N_ENTITIES + extra) if extra else None])
+        groups[DISLIKED] = (entities.split(json_data[DISLIKED]), (N_ENTITIES + extra) if extra else None)
     else:
         num_rand += (N_ENTITIES - (N_ENTITIES // 2)) if extra else N_ENTITIES
 
@@ -231,106 +336,88 @@ def feedback():
 
     if len(rated_entities) < MINIMUM_SEED_SIZE:
         # Find the relevant neighbors (with page rank) from the liked and disliked seeds
-        results = get_next_entities(parallel)
-        requested_entities = [entity for result in results for entity in result]
-        result_entities = random_entities + [record_to_entity(entity) for entity in requested_entities]
+        result_entities = random_entities + get_related_entities(groups, seen_entities)
     else:
-        parallel.append([get_related_entities, [item['uri'] for item in random_entities], seen_entities, num_rand])
-        results = get_next_entities(parallel)
-        requested_entities = [entity for result in results for entity in result]
-        result_entities = [record_to_entity(entity) for entity in requested_entities]
+        groups['random'] = (entities.split([item['uri'] for item in random_entities]), num_rand)
+        result_entities = get_related_entities(groups, seen_entities)
 
     no_duplicates = sorted({r['uri']: r for r in result_entities}.values(), key=lambda x: x['description'])
 
     return jsonify(no_duplicates)
 
 
-def get_next_entities(parallel):
-    f = []
-    with ThreadPoolExecutor(max_workers=5) as e:
-        for args in parallel:
-            f.append(e.submit(*args))
-
-    wait(f)
+def get_related_entities(groups, seen_entities):
+    """
+    Samples the relevant neighbours of every group of {name: (entities, limit)}, with all groups queried at once.
+    If the query misses its deadline, the slots are filled with popularity samples instead.
+    """
+    sizes = {name: limit if limit else N_ENTITIES for name, (_, limit) in groups.items()}
+    with STAGE_DURATION.time(stage='graph'):
+        neighbors = SCHEDULER.run(get_relevant_neighbors_batch,
+                                  {name: (entities, 25) for name, (entities, _) in groups.items()}, seen_entities,
+                                  timeout=QUERY_DEADLINE)
 
-    return [element.result() for element in f]
+    if neighbors is None:
+        return _get_samples(sum(sizes.values()))
 
+    with STAGE_DURATION.time(stage='neighbours'):
+        entities = [record_to_entity(entity) for name, size in sizes.items()
+                    for entity in sample_relevant_neighbours(neighbors[name], size)]
 
-def get_related_entities(entities, seen_entities, limit=None):
-    return sample_relevant_neighbours(get_relevant_neighbors(entities, seen_entities), limit if limit else N_ENTITIES)
+    SAMPLE_SIZE.observe(len(entities), source='neighbours')
 
-
-def get_session_path(header):
-    return os.path.join(SESSION_PATH, f'{header}.json')
+    return entities
 
 
 def update_session(liked, disliked, unknown, popularity_sampled, final=False):
     header = get_authorization()
-    user_session_path = get_session_path(header)
-
-    if header not in SESSION:
-        if os.path.exists(user_session_path):
-            with open(user_session_path, 'r') as fp:
-                SESSION[header] = json.load(fp)
-        else:
-            SESSION[header] = {
-                LIKED: [],
-                DISLIKED: [],
-                UNKNOWN: [],
-                TIMESTAMPS: [],
-                POPULARITY: [],
-                FINAL: False,
-                VERSION: CURRENT_VERSION
-            }
-
-        # Ensure that all the user's sessions are loaded into memory
-        get_sessions(header)
-
-    SESSION[header][TIMESTAMPS] += [time.time()]
-    SESSION[header][LIKED] += list(liked)
-    SESSION[header][DISLIKED] += list(disliked)
-    SESSION[header][POPULARITY] += list(popularity_sampled)
-    SESSION[header][UNKNOWN] += list(unknown)
-    SESSION[header][FINAL] = final
-
-    with open(user_session_path, 'w+') as fp:
-        json.dump(SESSION[header], fp, indent=True)
+
+    with STAGE_DURATION.time(stage='session_write'):
+        # Ensures that all the user's sessions are loaded into memory
+        STORE.session(header, CURRENT_VERSION)
+
+        # Only the new interaction is written, the full session is compacted periodically
+        record = make_record(time.time(), liked, disliked, unknown, popularity_sampled, final)
+        size = STORE.append(header, record)
+        record_interaction(header, record, last_sequence(STORE.get(header)))
+
+    SESSION_WRITE_BYTES.inc(size or 0)
 
 
 def get_seen_entities():
     header = get_authorization()
 
-    if header not in SESSION:
+    if header not in STORE:
         return []
 
-    return get_current_session_entities() + SESSION[header][UNKNOWN]
+    return np.concatenate((get_current_session_entities(), STORE.get(header)[UNKNOWN]))
 
 
 def get_current_session_entities():
     header = get_authorization()
 
-    if header not in SESSION:
+    if header not in STORE:
         return []
 
-    return get_liked_entities() + get_disliked_entities()
+    return np.concatenate((get_liked_entities(), get_disliked_entities()))
 
 
 def get_liked_entities():
     header = get_authorization()
 
-    if header not in SESSION:
+    if header not in STORE:
         return []
 
-    return SESSION[header][LIKED]
+    return STORE.get(header)[LIKED]
 
 
 def get_disliked_entities():
     header = get_authorization()
 
-    if header not in SESSION:
+    if header not in STORE:
         return []
 
-    return SESSION[header][DISLIKED]
+    return STORE.get(header)[DISLIKED]
 
 
 def is_invalid_request():
@@ -344,43 +431,16 @@ def get_authorization():
 
 
 def get_cross_session_entities():
-    header = get_authorization()
-    
-    entities = [get_cross_session_entities_generic(header, name) for name in [LIKED, DISLIKED, UNKNOWN]]
-    entities.append(reduce(lambda a, b: a + b, entities))
-
-    return entities
-
-
-def get_cross_session_entities_generic(header, type):
-    results = []
-    head = header.split('+')[0]
-
-    for key, value in SESSION.items():
-        if key.startswith(head):
-            results.extend(value[type])
-
-    return results
+    return STORE.cross_session_entities(get_authorization())
 
 
 def get_sessions(header):
-    head = header.split('+')[0]  # Get initial head
-    if head in LOADED_HEADS:
-        return
-    
-    # Match all headers containing initial head
-    for filename in glob.glob(os.path.join(SESSION_PATH, f'{head}+*.json')):
-        with open(filename, 'r') as f:
-            file_head = os.path.basename(os.path.splitext(filename)[0])
-            if file_head == header:
-                continue
-
-            SESSION[file_head] = json.load(f)
-
-    LOADED_HEADS.add(head)
+    STORE.load(header)
 
 
 if __name__ == "__main__":
+    # The session pool would run this script again in each of its processes
+    load_in_process()
     app.run()
 else:
     application = app  # For GUnicorn
@@ -1,8 +1,47 @@
-from neo4j import GraphDatabase
+import argparse
+import json
+import threading
+from collections import defaultdict
+from functools import wraps
 from os import environ
 
+import numpy as np
+from neo4j import GraphDatabase
+
+import dataset
+from configuration import NEIGHBOR_CACHE_SIZE, NEIGHBOR_CACHE_TTL, NEIGHBOR_CACHE_OVERFETCH
+from entities import get_entity_index
+from local_graph import get_graph, GRAPH_BACKEND
+from utility.cache import LRUCache
+from utility.metrics import REGISTRY
+
 _uri = environ.get('BOLT_URI', 'bolt://localhost:7778')
-driver = GraphDatabase.driver(_uri, auth=("neo4j", "root123"))
+_driver = {}
+_driver_lock = threading.Lock()
+
+# Particle filtering results per seed set, before the user's seen entities are removed
+neighbor_cache = LRUCache(NEIGHBOR_CACHE_SIZE, NEIGHBOR_CACHE_TTL)
+
+GRAPH_QUERY_DURATION = REGISTRY.histogram('mindreader_graph_query_duration_seconds',
+                                          'Duration of candidate queries against the graph, by query and backend')
+REGISTRY.gauge('mindreader_neighbor_cache_lookups_total', 'Neighbour cache lookups, by result',
+               lambda: {(('result', 'hit'),): neighbor_cache.hits, (('result', 'miss'),): neighbor_cache.misses},
+               kind='counter')
+REGISTRY.gauge('mindreader_neighbor_cache_size', 'Seed sets held by the neighbour cache', lambda: len(neighbor_cache))
+
+# Labels that make up the groups get_relevant_neighbors takes its top k from
+GROUP_LABELS = ['director', 'actor', 'subject', 'movie', 'company', 'decade', 'genre', 'person', 'category']
+
+
+def get_driver():
+    """
+    Returns the driver, connecting on first use so an unavailable graph does not block importing this module.
+    """
+    with _driver_lock:
+        if 'driver' not in _driver:
+            _driver['driver'] = GraphDatabase.driver(_uri, auth=("neo4j", "root123"))
+
+        return _driver['driver']
 
 
 def _generic_get(tx, query, args=None):
@@ -12,73 +51,358 @@ def _generic_get(tx, query, args=None):
         return tx.run(query)
 
 
+ENTITIES_QUERY = """
+            MATCH (n) RETURN n.uri AS uri, n.name AS name, LABELS(n) AS labels
+            """
+
+TRIPLES_QUERY = """
+            MATCH (h)-[r]->(t) RETURN h.uri AS head_uri, TYPE(r) AS relation, t.uri AS tail_uri
+            """
+
+
+def _chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _stream(query, chunk_size):
+    """
+    Yields the records of a query in lists of chunk_size, pulling them from the result as they are consumed.
+    """
+    with get_driver().session() as session:
+        yield from _chunks(session.run(query), chunk_size)
+
+
 def get_number_entities():
+    if GRAPH_BACKEND == 'memory':
+        return len(get_graph())
+
     query = """
             MATCH (n) RETURN COUNT(n) as count
             """
 
-    with driver.session() as session:
+    with get_driver().session() as session:
         res = session.read_transaction(_generic_get, query)
         res = res.single()
 
     return res['count']
 
 
+def get_graph_stats():
+    if GRAPH_BACKEND == 'memory':
+        return get_graph().stats()
+
+    query = """
+            CALL apoc.meta.stats() YIELD nodeCount, relCount
+            RETURN nodeCount, relCount
+            """
+
+    with get_driver().session() as session:
+        res = session.read_transaction(_generic_get, query).single()
+
+        return {'nodes': res['nodeCount'], 'relationships': res['relCount']}
+
+
+def get_graph_version():
+    """
+    Version of the graph's contents: that of the loaded CSVs with the memory backend, and otherwise the version
+    stored on a GraphVersion node by the import, or None if there is none.
+    """
+    if GRAPH_BACKEND == 'memory':
+        return get_graph().version
+
+    query = """
+            MATCH (v:GraphVersion)
+            RETURN v.version AS version
+            LIMIT 1
+            """
+
+    with get_driver().session() as session:
+        res = session.read_transaction(_generic_get, query).single()
+
+        return res['version'] if res else None
+
+
 def get_counts():
+    if GRAPH_BACKEND == 'memory':
+        return get_graph().counts()
+
     query = """
             CALL apoc.meta.stats() YIELD labels
             RETURN labels {.Person, .Category, .Decade, .Company, .Movie} AS counts
             """
 
-    with driver.session() as session:
+    with get_driver().session() as session:
         res = session.read_transaction(_generic_get, query).single()
 
         return res[0]
 
 
 def get_entities():
-    query = """
-            MATCH (n) RETURN n.uri AS uri, n.name AS name, LABELS(n) AS labels
-            """
-            
-    with driver.session() as session:
+    if GRAPH_BACKEND == 'memory':
+        return list(get_graph().entities())
+
+    query = ENTITIES_QUERY
+
+    with get_driver().session() as session:
         res = session.read_transaction(_generic_get, query)
 
     return [record for record in res]
 
 
 def get_triples():
-    query = """
-            MATCH (h)-[r]->(t) RETURN h.uri AS head_uri, TYPE(r) AS relation, t.uri AS tail_uri
-            """
+    if GRAPH_BACKEND == 'memory':
+        return list(get_graph().triples())
 
-    with driver.session() as session:
+    query = TRIPLES_QUERY
+
+    with get_driver().session() as session:
         res = session.read_transaction(_generic_get, query)
 
     return [record for record in res]
 
 
-def get_last_batch(source_uris, seen):
+def iter_entities(chunk_size=10000):
+    if GRAPH_BACKEND == 'memory':
+        return _chunks(get_graph().entities(), chunk_size)
+
+    return _stream(ENTITIES_QUERY, chunk_size)
+
+
+def iter_triples(chunk_size=10000):
+    if GRAPH_BACKEND == 'memory':
+        return _chunks(get_graph().triples(), chunk_size)
+
+    return _stream(TRIPLES_QUERY, chunk_size)
+
+
+def _timed(name):
+    def decorator(query):
+        @wraps(query)
+        def wrapper(*args):
+            with GRAPH_QUERY_DURATION.time(query=name, backend=GRAPH_BACKEND):
+                return query(*args)
+
+        return wrapper
+
+    return decorator
+
+
+# An empty entity set, as (ids, URIs outside the entity index) pairs
+NO_ENTITIES = (np.empty(0, dtype=np.int32), [])
+
+
+def _uris(entities):
+    ids, uris = entities
+
+    return get_entity_index().uris(ids) + list(uris)
+
+
+@_timed('last_batches')
+def _query_last_batches(groups, seen):
+    """
+    Runs particle filtering for every group of {name: (sources, limit)} in a single query, returning the
+    highest scored unseen movies of each group by name.
+    """
+    if GRAPH_BACKEND == 'memory':
+        # Every node of the local graph is in the entity index, so the URIs outside it are not nodes
+        graph = get_graph()
+        seen = graph.nodes(seen[0])
+
+        return {name: graph.last_batch(graph.nodes(ids), seen, limit) for name, ((ids, _), limit) in groups.items()}
+
     query = """
-            MATCH (n) WHERE n.uri IN $uris WITH COLLECT(n) AS nLst
+            UNWIND $groups AS g
+            MATCH (n) WHERE n.uri IN g.uris WITH g, COLLECT(n) AS nLst
             CALL particlefiltering(nLst, 0, 100) YIELD nodeId, score
-            MATCH (n) WHERE n:Movie AND id(n) = nodeId AND NOT n.uri IN $seen RETURN n.uri AS uri, score
+            MATCH (n) WHERE n:Movie AND id(n) = nodeId AND NOT n.uri IN $seen
+                WITH g.name AS group, g.limit AS lim, n.uri AS uri, score
             ORDER BY score DESC
-            LIMIT 10
+                WITH group, lim, collect({uri: uri, score: score}) AS results
+            RETURN group, results[..lim] AS results
     """
 
-    args = {'uris': source_uris, 'seen': seen}
+    # The graph only knows URIs
+    args = {'groups': [{'name': name, 'uris': _uris(sources), 'limit': limit}
+                       for name, (sources, limit) in groups.items()],
+            'seen': _uris(seen)}
 
-    with driver.session() as session:
-        res = session.read_transaction(_generic_get, query, args)
-        res = [{'uri': r['uri'], 'score': r['score']} for r in res]
+    res = {name: [] for name in groups}
+    with get_driver().session() as session:
+        for r in session.read_transaction(_generic_get, query, args):
+            res[r['group']] = [{'uri': result['uri'], 'score': result['score']} for result in r['results']]
 
     return res
 
 
-def get_relevant_neighbors(uri_list, seen_uri_list, k=25):
+@_timed('relevant_neighbors')
+def _query_relevant_neighbors(groups, seen):
+    """
+    Runs particle filtering for every group of {name: (seeds, k)} in a single query, returning the top k unseen
+    entities of every combination of labels in each group by name.
+    """
+    if GRAPH_BACKEND == 'memory':
+        graph = get_graph()
+        seen = graph.nodes(seen[0])
+
+        return {name: graph.relevant_neighbors(graph.nodes(ids), seen, k) for name, ((ids, _), k) in groups.items()}
+
     query = """
-             MATCH (n) WHERE n.uri IN $uris WITH COLLECT(n) AS nLst
+            UNWIND $groups AS g
+            MATCH (n) WHERE n.uri IN g.uris WITH g, COLLECT(n) AS nLst
+            CALL particlefiltering(nLst, 0, 100) YIELD nodeId, score
+            MATCH (n) WHERE id(n) = nodeId AND NOT n.uri IN $seen
+                WITH DISTINCT g.name AS group, g.k AS k, id(n) AS id, score, n.name AS name, labels(n) AS l
+            ORDER BY score DESC
+                WITH group, k, l, collect({id: id, s: score, n: name})[..k] AS topk
+            UNWIND topk AS t
+                WITH group, t.id AS id, t.s AS score, t.n AS name
+            OPTIONAL MATCH (r)<--(m:Movie) WHERE id(r) = id AND NOT r:Movie
+                WITH group, algo.asNode(id) AS r, m, score
+            ORDER BY m.weight DESC
+                WITH group, r, collect(DISTINCT m)[..5] as movies, score
+            RETURN group, r:Director AS director, r:Actor AS actor, r.imdb AS imdb, r:Subject AS subject,
+                   r:Movie as movie, r:Company AS company, r:Decade AS decade, r.uri AS uri, r.name AS name,
+                   r:Genre as genre, r:Person as person, r:Category as category, r.image AS image, r.year AS year,
+                   movies, score
+            """
+
+    args = {'groups': [{'name': name, 'uris': _uris(seeds), 'k': k} for name, (seeds, k) in groups.items()],
+            'seen': _uris(seen)}
+
+    res = {name: [] for name in groups}
+    with get_driver().session() as session:
+        for r in session.read_transaction(_generic_get, query, args):
+            res[r['group']].append(r)
+
+    return res
+
+
+def _cached(name, groups, query):
+    """
+    Returns the unfiltered result of query for every group of seeds, with the entity ids of the results, fetching
+    NEIGHBOR_CACHE_OVERFETCH extra results so that they can be shared by users with different seen entities. Groups
+    missing from the cache are fetched together in one query.
+    """
+    keys = {group: (name, tuple(np.unique(ids).tolist()), tuple(sorted(set(uris))), limit)
+            for group, ((ids, uris), limit) in groups.items()}
+    res = {group: neighbor_cache.get(key) for group, key in keys.items()}
+
+    missing = {group: ((np.asarray(keys[group][1], dtype=np.int32), list(keys[group][2])),
+                       keys[group][3] + NEIGHBOR_CACHE_OVERFETCH)
+               for group, records in res.items() if records is None}
+    if missing:
+        entities = get_entity_index()
+        for group, records in query(missing, NO_ENTITIES).items():
+            res[group] = (records, entities.intern([r['uri'] for r in records]))
+            neighbor_cache.put(keys[group], res[group])
+
+    return res
+
+
+def _is_seen(res, seen):
+    """
+    Whether each of the records of a cached result is among the seen entities, by id or by URI.
+    """
+    records, ids = res
+    seen_ids, seen_uris = seen
+
+    is_seen = np.isin(ids, seen_ids)
+    if seen_uris:
+        # URIs the index lacked when they were rated may have been given ids by queries since
+        is_seen |= np.fromiter((r['uri'] in seen_uris for r in records), dtype=bool, count=len(records))
+
+    return is_seen.tolist()
+
+
+def _unseen_last_batch(res, seen, limit):
+    records, _ = res
+    unseen = [r for r, is_seen in zip(records, _is_seen(res, seen)) if not is_seen]
+
+    # The cached result was cut off too early for this user
+    if len(unseen) < limit and len(records) >= limit + NEIGHBOR_CACHE_OVERFETCH:
+        return None
+
+    return unseen[:limit]
+
+
+def _unseen_relevant_neighbors(res, seen, k):
+    records, _ = res
+
+    groups = defaultdict(list)
+    for r, is_seen in zip(records, _is_seen(res, seen)):
+        groups[tuple(bool(r[label]) for label in GROUP_LABELS)].append((r, is_seen))
+
+    result = []
+    for members in groups.values():
+        unseen = sorted([r for r, is_seen in members if not is_seen], key=lambda r: r['score'], reverse=True)
+
+        # The cached group was cut off too early for this user
+        if len(unseen) < k and len(members) >= k + NEIGHBOR_CACHE_OVERFETCH:
+            return None
+
+        result.extend(unseen[:k])
+
+    return result
+
+
+def _filter_seen(name, groups, seen, query, unseen):
+    res = _cached(name, groups, query)
+
+    seen = (np.unique(np.asarray(seen[0], dtype=np.int32)), set(seen[1]))
+    result = {group: unseen(res[group], seen, limit) for group, (_, limit) in groups.items()}
+
+    # Groups the cached results did not cover are queried with the seen entities filtered out
+    uncovered = {group: groups[group] for group, records in result.items() if records is None}
+    if uncovered:
+        result.update(query(uncovered, seen))
+
+    return result
+
+
+def get_last_batches(groups, seen):
+    """
+    The highest scored unseen movies for every group of {name: (sources, limit)}, by name. Entities are given as
+    pairs of their ids and the URIs of those outside the entity index, as EntityIndex.split returns them, and
+    results by their URIs.
+    """
+    return _filter_seen('last_batch', groups, seen, _query_last_batches, _unseen_last_batch)
+
+
+def get_relevant_neighbors_batch(groups, seen):
+    """
+    The top k unseen entities per combination of labels for every group of {name: (seeds, k)}, by name.
+    """
+    return _filter_seen('relevant_neighbors', groups, seen, _query_relevant_neighbors, _unseen_relevant_neighbors)
+
+
+def get_last_batch(sources, seen, limit=10):
+    return get_last_batches({'batch': (sources, limit)}, seen)['batch']
+
+
+def get_relevant_neighbors(seeds, seen, k=25):
+    return get_relevant_neighbors_batch({'neighbors': (seeds, k)}, seen)['neighbors']
+
+
+# The per-group queries the batched ones replaced, kept to check the batched ones against
+SINGLE_LAST_BATCH_QUERY = """
+            MATCH (n) WHERE n.uri IN $uris WITH COLLECT(n) AS nLst
+            CALL particlefiltering(nLst, 0, 100) YIELD nodeId, score
+            MATCH (n) WHERE n:Movie AND id(n) = nodeId AND NOT n.uri IN $seen RETURN n.uri AS uri, score
+            ORDER BY score DESC
+            LIMIT $limit
+            """
+
+SINGLE_RELEVANT_NEIGHBORS_QUERY = """
+            MATCH (n) WHERE n.uri IN $uris WITH COLLECT(n) AS nLst
             CALL particlefiltering(nLst, 0, 100) YIELD nodeId, score
             MATCH (n) WHERE id(n) = nodeId AND NOT n.uri IN $seen
                 WITH DISTINCT id(n) AS id, score, n.name AS name, labels(n) AS l
@@ -95,10 +419,75 @@ def get_relevant_neighbors(uri_list, seen_uri_list, k=25):
                    r:Person as person, r:Category as category, r.image AS image, r.year AS year, movies, score
             """
 
-    args = {'uris': uri_list, 'seen': seen_uri_list, 'k': k}
 
-    with driver.session() as session:
-        res = session.read_transaction(_generic_get, query, args)
-        res = [r for r in res]
+def _single(query, args):
+    with get_driver().session() as session:
+        return list(session.read_transaction(_generic_get, query, args))
 
-    return res
+
+def _neighbor_summary(records):
+    # Top k URIs per combination of labels, and the movies listed for each
+    top = defaultdict(set)
+    movies = {}
+    for r in records:
+        top[tuple(bool(r[label]) for label in GROUP_LABELS)].add(r['uri'])
+        movies[r['uri']] = [m['uri'] for m in r['movies']]
+
+    return top, movies
+
+
+def _neighbor_differences(records, other):
+    top, movies = _neighbor_summary(records)
+    other_top, other_movies = _neighbor_summary(other)
+
+    return {
+        'label_groups': len(set(top) ^ set(other_top)),
+        'top_k': sum(len(top[labels] ^ other_top[labels]) for labels in set(top) | set(other_top)),
+        'movies': sum(movies[uri] != other_movies[uri] for uri in set(movies) & set(other_movies))
+    }
+
+
+def verify_batched(groups=3, seeds=5, limit=10, k=25):
+    """
+    Runs the batched Neo4j queries next to the per-group queries they replaced, for groups of random catalog movies,
+    and returns the differences of every group. The per-group queries are run twice, so that differences of the
+    batching can be told from those between runs of particle filtering.
+    """
+    entities = get_entity_index()
+    seed_uris = {f'group-{i}': [row['uri'] for row in dataset.sample(seeds, [])] for i in range(groups)}
+
+    last_batches = _query_last_batches({name: (entities.split(uris), limit) for name, uris in seed_uris.items()},
+                                       NO_ENTITIES)
+    neighbors = _query_relevant_neighbors({name: (entities.split(uris), k) for name, uris in seed_uris.items()},
+                                          NO_ENTITIES)
+
+    differences = {}
+    for name, uris in seed_uris.items():
+        single_last = [_single(SINGLE_LAST_BATCH_QUERY, {'uris': uris, 'seen': [], 'limit': limit}) for _ in range(2)]
+        single_neighbors = [_single(SINGLE_RELEVANT_NEIGHBORS_QUERY, {'uris': uris, 'seen': [], 'k': k})
+                            for _ in range(2)]
+
+        batched = [r['uri'] for r in last_batches[name]]
+        single = [[r['uri'] for r in records] for records in single_last]
+        differences[name] = {
+            'last_batch': {'batched': len(set(batched) ^ set(single[0])),
+                           'between_runs': len(set(single[0]) ^ set(single[1]))},
+            'relevant_neighbors': {'batched': _neighbor_differences(neighbors[name], single_neighbors[0]),
+                                   'between_runs': _neighbor_differences(single_neighbors[0], single_neighbors[1])}
+        }
+
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Graph query maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    verify_parser = subparsers.add_parser('verify-batched',
+                                          help='Compare the batched Neo4j queries with the per-group queries')
+    verify_parser.add_argument('--groups', type=int, default=3)
+    verify_parser.add_argument('--seeds', type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == 'verify-batched':
+        print(json.dumps(verify_batched(args.groups, args.seeds), indent=2))
@@ -1,75 +1,109 @@
+import threading
+import time
 from random import shuffle
-from numpy import random, asarray, log2, arange
 
-from dataset import movies
+from numpy import random, asarray, log, log2, lexsort, minimum, flatnonzero, zeros
+
+import dataset
+from configuration import ENTITY_COUNTS_INTERVAL
 from queries import get_counts
 
-ENTITY_COUNTS = get_counts()
+_entity_counts = {'value': None, 'time': 0, 'refreshing': False}
+_entity_counts_lock = threading.Lock()
 
 
-def _choice(lst, weights, remove=True):
-    if not lst:
-        return None
+def _refresh_entity_counts():
+    try:
+        _entity_counts['value'] = get_counts()
+    finally:
+        _entity_counts['refreshing'] = False
 
-    w_sum = weights.sum(axis=0)
-    indices = arange(len(lst))
 
-    if w_sum:
-        idx = random.choice(indices, p=weights / w_sum, replace=True)
-    else:
-        idx = random.choice(indices)
+def entity_counts():
+    """
+    Number of entities per label, counted on first use and recounted in the background every
+    ENTITY_COUNTS_INTERVAL seconds, keeping the previous counts if the graph is unavailable.
+    """
+    with _entity_counts_lock:
+        if _entity_counts['value'] is None:
+            _entity_counts['time'] = time.time()
+            _entity_counts['value'] = get_counts()
+        elif time.time() - _entity_counts['time'] >= ENTITY_COUNTS_INTERVAL and not _entity_counts['refreshing']:
+            _entity_counts['time'] = time.time()
+            _entity_counts['refreshing'] = True
+            threading.Thread(target=_refresh_entity_counts, daemon=True).start()
 
-    element = lst[idx]
-    if remove:
-        lst.pop(idx)
+        return _entity_counts['value']
 
-    return element
 
+def multiplier(entity_type):
+    return {
+        'decade': 0.25,
+        'company': 0.5
+    }.get(entity_type, 1.0)
 
-def _weights(records):
-    return asarray([entity['score'] for entity in records])
 
+def _type_weights():
+    counts = entity_counts()
+    names = list(counts.keys())
 
-def _record_choice(records, n=1):
-    if n == 1:
-        return _choice(records, _weights(records))
-    else:
-        result = []
+    # Labels without entities get no weight, rather than a negative infinite one
+    return names, asarray([log2(counts[name] or 1) * multiplier(name.lower()) for name in names])
 
-        while records and len(result) < n:
-            result.append(_choice(records, _weights(records)))
 
-        return result
+def _stratify(weights, sizes, n):
+    """
+    Distributes n picks over types with probability proportional to their weights, without exceeding the number of
+    entities of each type. Picks that land on an exhausted type are redrawn among the remaining types.
+    """
+    counts = zeros(len(sizes), dtype=int)
+    target = min(n, sizes.sum())
 
+    while counts.sum() < target:
+        available = counts < sizes
+        p = weights * available
+        if p.sum() <= 0:
+            p = available.astype(float)
 
-def _subselection(entities, entity_type):
-    return [entity for entity in entities if entity[entity_type]]
+        counts = minimum(counts + random.multinomial(target - counts.sum(), p / p.sum()), sizes)
 
+    return counts
 
-def multiplier(entity_type):
-    return {
-        'decade': 0.25,
-        'company': 0.5
-    }.get(entity_type, 1.0)
+
+def _weighted_sample(scores, n):
+    """
+    Picks n indices without replacement, with probability proportional to scores (Efraimidis-Spirakis).
+    Zero scores are only picked once the positive scores are exhausted, in random order.
+    """
+    positive = scores > 0
+    keys = zeros(len(scores)) - float('inf')
+    keys[positive] = log(random.random(positive.sum())) / scores[positive]
+
+    return lexsort((random.random(len(scores)), keys))[::-1][:n]
 
 
 def sample_relevant_neighbours(entities, num_entities):
     """
-    Attempts to sample n_actors, n_directors and n_subjects from the entities.
-    Returns an array of entities of size n_actors + n_directors + n_subjects.
-    If there are not enough of either type of entity, the remaining space is filled
-    out with entities from the entity list, sampled in order of PageRank.
+    Samples num_entities from the entities, stratified by type. Types are chosen with probability proportional to
+    the log of their number of entities (scaled by their multiplier), and entities within a type proportional to
+    their score.
     """
-    all_entities = [(log2(value) * multiplier(key.lower()), _subselection(entities, key.lower()), key) for key, value in ENTITY_COUNTS.items()]
+    if not entities:
+        return []
+
+    names, weights = _type_weights()
+
+    # Group the entities by type once
+    scores = asarray([entity['score'] for entity in entities], dtype=float)
+    membership = asarray([[bool(entity[name.lower()]) for name in names] for entity in entities])
+    counts = _stratify(weights, membership.sum(axis=0), num_entities)
 
     result = list()
-    print(len(all_entities))
-    while len(result) < num_entities and any(subselection for _, subselection, _ in all_entities):
-        count, subset, name = _choice(all_entities, asarray([count for count, _, _ in all_entities]), remove=False)
-        if not subset:
-            continue
+    for index in flatnonzero(counts):
+        members = flatnonzero(membership[:, index])
+        result.extend(entities[member] for member in members[_weighted_sample(scores[members], counts[index])])
 
-        result.append(_record_choice(subset))
+    shuffle(result)
 
     return result
 
@@ -108,7 +142,11 @@ def get_description(record):
 
 
 def record_to_entity(record):
-    movie = _movie_from_uri(record['uri']) if record['movie'] else None
+    # Resolve the entity itself and its related movies in a single lookup
+    uris = [record['uri']] + [node['uri'] for node in record['movies']]
+    movie, *related = _movies_from_uris(uris)
+    if not record['movie']:
+        movie = None
 
     return {
         "name": f'{movie["title"]} ({movie["year"]})' if movie else record['name'],
@@ -116,19 +154,13 @@ def record_to_entity(record):
         "imdb": record['imdb'],
         "description": get_description(record),
         "summary": movie["summary"] if movie else None,
-        "movies": ['{title} ({year})'.format(**_movie_from_uri(node['uri'])) for node in record['movies']]
+        "movies": ['{title} ({year})'.format(**related_movie) for related_movie in related if related_movie]
     }
 
 
 def _movie_from_uri(uri):
-    try:
-        row = iter(movies.loc[movies['uri'] == uri, movies.columns].values)
-        if not row:
-            return None
-
-        return {
-            attr: val
-            for attr, val in zip(movies.columns, next(row, []))
-        }
-    except Exception:
-        return None
\ No newline at end of file
+    return dataset.get_catalog().get(uri)
+
+
+def _movies_from_uris(uris):
+    return dataset.get_catalog().lookup(uris)
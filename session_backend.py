@@ -0,0 +1,591 @@
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import environ
+
+from configuration import SESSION_PATH, SESSION_DATABASE, FINAL, VERSION, LIKED, DISLIKED, UNKNOWN, TIMESTAMPS, \
+    SESSION_LOAD_PROCESSES, SESSION_LOAD_CHUNK_SIZE
+from utility.journal import session_tokens, load_session, create_session, append_record, new_session, \
+    apply_record, is_empty, token_chunks, load_sessions, session_mtimes, SNAPSHOT_EXTENSION, \
+    JOURNAL_EXTENSION
+
+_backend = environ.get('SESSION_BACKEND', 'json')
+
+# Session directory (json) or database (sqlite) in place of the configured one, such as for load tests
+_storage = environ.get('SESSION_STORAGE')
+_instances = {}
+
+# Manifest of a JSON session directory, stored in the directory itself
+MANIFEST_FILE = 'manifest.db'
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def _session_pool():
+    """
+    Returns the pool loading chunks of sessions, shared by every scan of this process. Its processes are started by
+    a fork server, as forking a worker could copy locks held by its other threads into them.
+    """
+    with _pool_lock:
+        if _pool.get('pid') != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            # Only the decoding code is imported ahead, the rest of the worker is never needed by the pool
+            context.set_forkserver_preload(['utility.journal'])
+            _pool['executor'] = ProcessPoolExecutor(SESSION_LOAD_PROCESSES, mp_context=context)
+            _pool['pid'] = os.getpid()
+
+        return _pool['executor']
+
+
+def _discard_pool():
+    with _pool_lock:
+        _pool.pop('pid', None)
+
+
+def load_in_process():
+    """
+    Loads sessions in this process rather than on the session pool. For scripts whose top level starts the app, as
+    the pool's processes run the main script again and would each build the app's state.
+    """
+    _pool['in_process'] = True
+
+
+def _thread_connection(local, path):
+    connection = getattr(local, 'connection', None)
+
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        local.connection = connection
+
+    return connection
+
+
+def _entry_matches(entry, filter_final=False, filter_empty=False, versions=None):
+    version, final, empty, _ = entry
+
+    return not (versions and version not in versions) and not (filter_final and not final) and \
+        not (filter_empty and empty)
+
+
+def _filter_clause(filter_final=False, filter_empty=False, versions=None):
+    """
+    SQL condition on the sessions table, aliased s, and its parameters, selecting the sessions passing the filters.
+    """
+    clauses, params = ['1'], []
+    if versions:
+        clauses.append(f's.version IN ({", ".join("?" * len(versions))})')
+        params.extend(versions)
+    if filter_final:
+        clauses.append('s.final = 1')
+    if filter_empty:
+        clauses.append('s.empty = 0')
+
+    return ' AND '.join(clauses), params
+
+
+class SessionManifest:
+    """
+    Version, final flag, emptiness, rating counts and last interaction of every session in a JSON session
+    directory, updated by every worker as it writes, along with the modification times of the session's files at
+    the time. Filtered scans open every session it does not list, or whose files have changed since (for instance
+    because an update failed, or a snapshot was restored by hand), so a missing or outdated manifest only costs time.
+    """
+
+    # Increased with every change to the schema, which drops the manifest of an older one
+    SCHEMA_VERSION = 2
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS manifest (
+            token TEXT PRIMARY KEY,
+            head TEXT NOT NULL,
+            version TEXT,
+            final INTEGER NOT NULL,
+            empty INTEGER NOT NULL,
+            liked INTEGER NOT NULL,
+            disliked INTEGER NOT NULL,
+            unknown INTEGER NOT NULL,
+            last_timestamp REAL,
+            snapshot_mtime INTEGER,
+            journal_mtime INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS manifest_head ON manifest (head);
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self._local = threading.local()
+
+        # Writes that failed, leaving the entries of their sessions outdated
+        self.errors = 0
+
+        connection = self._connection()
+        if connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            connection.executescript('DROP TABLE IF EXISTS manifest;')
+            connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+        with connection:
+            connection.executescript(self.SCHEMA)
+
+    def _connection(self):
+        return _thread_connection(self._local, self.path)
+
+    def _row(self, token, session):
+        """
+        Entry of a session, which must have just been written or read.
+        """
+        timestamps = session[TIMESTAMPS]
+
+        return (token, token.split('+')[0], session.get(VERSION), int(bool(session.get(FINAL))),
+                int(is_empty(session)), len(session[LIKED]), len(session[DISLIKED]), len(session[UNKNOWN]),
+                timestamps[-1] if timestamps else None) + session_mtimes(self.directory, token)
+
+    def update(self, token, session):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               self._row(token, session))
+
+    def entries(self):
+        """
+        Returns the (version, final, empty, (snapshot_mtime, journal_mtime)) of every listed session by token.
+        """
+        return {token: (version, final, empty, (snapshot_mtime, journal_mtime))
+                for token, version, final, empty, snapshot_mtime, journal_mtime in self._connection().execute(
+                    'SELECT token, version, final, empty, snapshot_mtime, journal_mtime FROM manifest')}
+
+    def current(self, token, entry):
+        """
+        Whether the files of a session are unchanged since its entry was written.
+        """
+        return entry[3] == session_mtimes(self.directory, token)
+
+    def rebuild(self, sessions):
+        """
+        Replaces the manifest with the given (token, session) pairs.
+        """
+        with self._connection() as connection:
+            connection.execute('DELETE FROM manifest')
+            connection.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (self._row(token, session) for token, session in sessions))
+
+            return connection.execute('SELECT COUNT(*) FROM manifest').fetchone()[0]
+
+
+class JsonSessionBackend:
+    """
+    Legacy backend with one snapshot and journal per session in a directory. Every worker keeps its own view,
+    so sessions are only read from disk once per user.
+    """
+    shared = False
+
+    def __init__(self, path=SESSION_PATH):
+        self.path = path
+
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        self.manifest = SessionManifest(path)
+
+    def count(self):
+        return len(glob.glob(os.path.join(self.path, '*.json')))
+
+    def load(self, token):
+        return load_session(self.path, token)
+
+    def _update_manifest(self, token, session):
+        # The session is already written, and scans will open it as its entry no longer matches its files
+        try:
+            self.manifest.update(token, session)
+        except sqlite3.Error:
+            self.manifest.errors += 1
+
+    def create(self, token, version):
+        session = create_session(self.path, token, version)
+        self._update_manifest(token, session)
+
+        return session
+
+    def append(self, token, record, session, snapshot=None):
+        size = append_record(self.path, token, record, session, snapshot)
+        self._update_manifest(token, session)
+
+        return size
+
+    def user_sessions(self, head):
+        sessions = {}
+        for filename in glob.glob(os.path.join(self.path, f'{head}+*.json')):
+            token = os.path.basename(os.path.splitext(filename)[0])
+            sessions[token] = self.load(token)
+
+        return sessions, 0
+
+    def tokens(self):
+        return session_tokens(self.path)
+
+    def iter_sessions(self):
+        for token in self.tokens():
+            yield token, self.load(token)
+
+    def _load_chunks(self, chunks, filters):
+        """
+        Loads and filters chunks of sessions on the session pool, yielding the sessions of every chunk in order.
+        """
+        first = list(itertools.islice(chunks, 2))
+
+        # Starting the pool is not worth it for a single chunk
+        if len(first) < 2 or SESSION_LOAD_PROCESSES < 2 or _pool.get('in_process'):
+            for chunk in itertools.chain(first, chunks):
+                yield load_sessions(self.path, chunk, filters)
+
+            return
+
+        executor = _session_pool()
+
+        # Chunks are submitted as the directory is listed, keeping a few per process in flight
+        pending = deque()
+        try:
+            for chunk in itertools.chain(first, chunks):
+                pending.append(executor.submit(load_sessions, self.path, chunk, filters))
+
+                if len(pending) > 2 * SESSION_LOAD_PROCESSES:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        except BrokenProcessPool:
+            # A process of the pool died, the next scan starts a new one
+            _discard_pool()
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def scan(self, filter_final=False, filter_empty=False, versions=None):
+        """
+        Yields the token of every session, with the session if it passes the filters and None otherwise, in the
+        order of iter_sessions. Sessions the manifest lists as not matching, and which have not changed since, are
+        not opened. The others are decoded and filtered by a pool of processes, so only matching sessions are sent
+        back to this one.
+        """
+        filters = (filter_final, filter_empty, versions)
+        entries = self.manifest.entries() if any(filters) else {}
+        listed = deque()
+
+        def to_load():
+            for chunk in token_chunks(self.path, SESSION_LOAD_CHUNK_SIZE):
+                skipped = {token for token in chunk if token in entries and not _entry_matches(entries[token], *filters)
+                           and self.manifest.current(token, entries[token])}
+                listed.append((chunk, skipped))
+                yield [token for token in chunk if token not in skipped]
+
+        for loaded in self._load_chunks(to_load(), filters):
+            sessions = dict(loaded)
+            chunk, skipped = listed.popleft()
+
+            for token in chunk:
+                if token in sessions:
+                    yield token, sessions[token]
+                elif token in skipped:
+                    yield token, None
+
+    def matching_tokens(self, filter_final=False, filter_empty=False, versions=None):
+        """
+        Returns the tokens of the sessions passing the filters. Only sessions missing from the manifest, or changed
+        since their entry, are opened.
+        """
+        filters = (filter_final, filter_empty, versions)
+        entries = self.manifest.entries()
+        tokens = []
+
+        def unlisted():
+            for chunk in token_chunks(self.path, SESSION_LOAD_CHUNK_SIZE):
+                listed = {token for token in chunk if token in entries and self.manifest.current(token, entries[token])}
+                tokens.extend(token for token in listed if _entry_matches(entries[token], *filters))
+                yield [token for token in chunk if token not in listed]
+
+        for loaded in self._load_chunks(unlisted(), filters):
+            tokens.extend(token for token, session in loaded if session is not None)
+
+        return tokens
+
+    def rebuild_manifest(self):
+        """
+        Regenerates the manifest from the sessions on disk.
+        """
+        return self.manifest.rebuild(self.scan())
+
+    def cursor(self):
+        return time.time()
+
+    def changes(self, cursor):
+        """
+        Returns the tokens of sessions written since cursor, and a cursor to pass on the next call.
+        Only file metadata is read, changed sessions still have to be loaded.
+        """
+        next_cursor = self.cursor()
+        tokens = set()
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                token, extension = os.path.splitext(entry.name)
+                if extension in [SNAPSHOT_EXTENSION, JOURNAL_EXTENSION] and entry.stat().st_mtime >= cursor:
+                    tokens.add(token)
+
+        return tokens, next_cursor
+
+
+class SqliteSessionBackend:
+    """
+    Backend storing sessions in a single SQLite database in WAL mode, shared by all workers. Sessions are an
+    optional snapshot (from migrated sessions) plus the interactions recorded since, indexed by head. Their version,
+    final flag and emptiness are kept as columns, so filtered scans only replay the sessions passing the filters.
+    """
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            head TEXT NOT NULL,
+            version TEXT,
+            final INTEGER NOT NULL DEFAULT 0,
+            snapshot TEXT,
+            empty INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS sessions_head ON sessions (head);
+        CREATE INDEX IF NOT EXISTS sessions_version_final ON sessions (version, final);
+
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token TEXT NOT NULL,
+            head TEXT NOT NULL,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_head ON events (head, id);
+        CREATE INDEX IF NOT EXISTS events_token ON events (token, id);
+    """
+
+    def __init__(self, path=SESSION_DATABASE):
+        self.path = path
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            connection.executescript(self.SCHEMA)
+
+        self._add_empty_column()
+
+    def _connection(self):
+        return _thread_connection(self._local, self.path)
+
+    def _add_empty_column(self):
+        """
+        Adds the empty column to databases created without it, filling it in from their sessions.
+        """
+        connection = self._connection()
+        if any(column[1] == 'empty' for column in connection.execute('PRAGMA table_info(sessions)')):
+            return
+
+        with connection:
+            # Checked again once the database is locked, as other workers may be adding it as well
+            connection.execute('BEGIN IMMEDIATE')
+            if any(column[1] == 'empty' for column in connection.execute('PRAGMA table_info(sessions)')):
+                return
+
+            connection.execute('ALTER TABLE sessions ADD COLUMN empty INTEGER NOT NULL DEFAULT 1')
+            connection.executemany('UPDATE sessions SET empty = ? WHERE token = ?',
+                                   [(int(is_empty(session)), token) for token, session in self.iter_sessions()])
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def _replay(self, sessions, rows):
+        cursor = 0
+        for event_id, token, version, record in rows:
+            if token not in sessions:
+                sessions[token] = new_session(version)
+
+            apply_record(sessions[token], json.loads(record))
+            cursor = event_id
+
+        return cursor
+
+    @staticmethod
+    def _from_snapshot(version, snapshot):
+        return json.loads(snapshot) if snapshot else new_session(version)
+
+    def load(self, token):
+        connection = self._connection()
+        row = connection.execute('SELECT version, snapshot FROM sessions WHERE token = ?', (token,)).fetchone()
+        if row is None:
+            return None
+
+        sessions = {token: self._from_snapshot(*row)}
+        self._replay(sessions, connection.execute(
+            'SELECT id, token, ?, record FROM events WHERE token = ? ORDER BY id', (row[0], token)))
+
+        return sessions[token]
+
+    def create(self, token, version):
+        """
+        Creates the session if it does not exist. Returns its snapshot, without the interactions recorded since.
+        """
+        with self._connection() as connection:
+            connection.execute('INSERT OR IGNORE INTO sessions (token, head, version) VALUES (?, ?, ?)',
+                               (token, token.split('+')[0], version))
+            row = connection.execute('SELECT version, snapshot FROM sessions WHERE token = ?', (token,)).fetchone()
+
+        return self._from_snapshot(*row)
+
+    def append(self, token, record, session=None):
+        line = json.dumps(record, separators=(',', ':'))
+
+        with self._connection() as connection:
+            connection.execute('INSERT INTO events (token, head, record) VALUES (?, ?, ?)',
+                               (token, token.split('+')[0], line))
+            connection.execute('UPDATE sessions SET final = ?, empty = empty AND ? WHERE token = ?',
+                               (int(record[FINAL]), int(is_empty({key: record.get(key, []) for key in
+                                                                  [LIKED, DISLIKED, UNKNOWN]})), token))
+
+        return len(line)
+
+    def user_sessions(self, head):
+        """
+        Returns all sessions of a user, and a cursor to pass to user_events for later changes.
+        """
+        connection = self._connection()
+
+        # Read snapshots and events in one transaction, so the cursor matches the returned sessions
+        with connection:
+            connection.execute('BEGIN')
+            sessions = {token: self._from_snapshot(version, snapshot) for token, version, snapshot in connection.execute(
+                'SELECT token, version, snapshot FROM sessions WHERE head = ?', (head,))}
+            cursor = self._replay(sessions, connection.execute(
+                'SELECT e.id, e.token, s.version, e.record FROM events e JOIN sessions s ON s.token = e.token '
+                'WHERE e.head = ? ORDER BY e.id', (head,)))
+
+        return sessions, cursor
+
+    def user_events(self, head, cursor):
+        """
+        Returns the (id, token, version, record) rows written for a user after cursor.
+        """
+        return self._connection().execute(
+            'SELECT e.id, e.token, s.version, e.record FROM events e JOIN sessions s ON s.token = e.token '
+            'WHERE e.head = ? AND e.id > ? ORDER BY e.id', (head, cursor)).fetchall()
+
+    def tokens(self):
+        return [token for token, in self._connection().execute('SELECT token FROM sessions')]
+
+    def cursor(self):
+        return self._connection().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def changes(self, cursor):
+        """
+        Returns the tokens of sessions written since cursor, and a cursor to pass on the next call.
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN')
+            tokens = {token for token, in connection.execute('SELECT DISTINCT token FROM events WHERE id > ?', (cursor,))}
+            next_cursor = connection.execute('SELECT COALESCE(MAX(id), ?) FROM events', (cursor,)).fetchone()[0]
+
+        return tokens, next_cursor
+
+    def iter_sessions(self):
+        connection = self._connection()
+        sessions = {token: self._from_snapshot(version, snapshot) for token, version, snapshot in connection.execute(
+            'SELECT token, version, snapshot FROM sessions')}
+        self._replay(sessions, connection.execute(
+            'SELECT e.id, e.token, s.version, e.record FROM events e JOIN sessions s ON s.token = e.token '
+            'ORDER BY e.id'))
+
+        return iter(sessions.items())
+
+    def scan(self, filter_final=False, filter_empty=False, versions=None):
+        """
+        Yields the token of every session, with the session if it passes the filters and None otherwise, in the
+        order of iter_sessions. Only the sessions passing the filters are read and replayed.
+        """
+        condition, params = _filter_clause(filter_final, filter_empty, versions)
+        connection = self._connection()
+
+        with connection:
+            connection.execute('BEGIN')
+            rows = connection.execute(f'SELECT s.token, s.version, s.snapshot, {condition} FROM sessions s',
+                                      params).fetchall()
+            sessions = {token: self._from_snapshot(version, snapshot) for token, version, snapshot, match in rows
+                        if match}
+            self._replay(sessions, connection.execute(
+                'SELECT e.id, e.token, s.version, e.record FROM events e JOIN sessions s ON s.token = e.token '
+                f'WHERE {condition} ORDER BY e.id', params))
+
+        for token, *_ in rows:
+            yield token, sessions.get(token)
+
+    def matching_tokens(self, filter_final=False, filter_empty=False, versions=None):
+        condition, params = _filter_clause(filter_final, filter_empty, versions)
+
+        return [token for token, in self._connection().execute(f'SELECT s.token FROM sessions s WHERE {condition}',
+                                                                params)]
+
+    def import_session(self, token, session):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions (token, head, version, final, snapshot, empty) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (token, token.split('+')[0], session.get(VERSION), int(bool(session.get(FINAL))),
+                                json.dumps(session, separators=(',', ':')), int(is_empty(session))))
+            connection.execute('DELETE FROM events WHERE token = ?', (token,))
+
+
+def get_backend(name=_backend):
+    if name not in _instances:
+        if name == 'sqlite':
+            _instances[name] = SqliteSessionBackend(_storage or SESSION_DATABASE)
+        else:
+            _instances[name] = JsonSessionBackend(_storage or SESSION_PATH)
+
+    return _instances[name]
+
+
+def migrate(source, target):
+    """
+    Copies every session from a JSON session directory into a SQLite database.
+    """
+    json_backend = JsonSessionBackend(source)
+    sqlite_backend = SqliteSessionBackend(target)
+
+    count = 0
+    for token, session in json_backend.iter_sessions():
+        sqlite_backend.import_session(token, session)
+        count += 1
+
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Session backend maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Copy JSON sessions into the SQLite backend')
+    migrate_parser.add_argument('--source', default=SESSION_PATH)
+    migrate_parser.add_argument('--target', default=SESSION_DATABASE)
+
+    manifest_parser = subparsers.add_parser('manifest', help='Rebuild the manifest of a JSON session directory')
+    manifest_parser.add_argument('--path', default=SESSION_PATH)
+
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        print(f'Migrated {migrate(args.source, args.target)} sessions to {args.target}')
+    elif args.command == 'manifest':
+        print(f'Indexed {JsonSessionBackend(args.path).rebuild_manifest()} sessions in {args.path}')
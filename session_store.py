@@ -0,0 +1,207 @@
+import json
+
+import numpy as np
+
+from configuration import LIKED, DISLIKED, UNKNOWN, TIMESTAMPS, FINAL, SEQUENCE
+from entities import get_entity_index
+from utility.journal import new_session, last_sequence, APPENDED_KEYS
+
+CATEGORIES = [LIKED, DISLIKED, UNKNOWN]
+
+# Key of an interned session listing the URIs of its entities outside the entity index, which its arrays refer to by
+# negative ids: -1 for the first, -2 for the second and so on
+OTHER_URIS = 'other_uris'
+
+
+def get_head(token):
+    return token.split('+')[0]
+
+
+def _intern(entities, uris, other_uris):
+    ids = entities.ids(uris)
+
+    for position in np.flatnonzero(ids < 0).tolist():
+        if uris[position] not in other_uris:
+            other_uris.append(uris[position])
+
+        ids[position] = -1 - other_uris.index(uris[position])
+
+    return ids
+
+
+def intern_session(session, other_uris=None):
+    """
+    Copies a session or record, with the entities of APPENDED_KEYS as arrays of entity ids. URIs outside the entity
+    index are added to other_uris, the list of the session a record belongs to, so the index only ever holds
+    entities of the graph and catalog.
+    """
+    entities = get_entity_index()
+    other_uris = [] if other_uris is None else other_uris
+
+    interned = {key: _intern(entities, value, other_uris) if key in APPENDED_KEYS else
+                list(value) if isinstance(value, list) else value for key, value in session.items()}
+    interned[OTHER_URIS] = other_uris
+
+    return interned
+
+
+def export_session(session):
+    """
+    Copies an interned session, with the URIs of its entities as stored by the session backends.
+    """
+    entities = get_entity_index()
+    other_uris = session[OTHER_URIS]
+
+    def uris(ids):
+        return [entities.uri(i) if i >= 0 else other_uris[-1 - i] for i in ids.tolist()]
+
+    return {key: uris(value) if key in APPENDED_KEYS else list(value) if isinstance(value, list) else value
+            for key, value in session.items() if key != OTHER_URIS}
+
+
+class UserHistory:
+    """
+    All sessions of a single user (head), with the entities they rated across sessions kept as sorted arrays of
+    entity ids. Sessions are held interned, as intern_session returns them. Entities outside the entity index are
+    kept as sets of URIs instead, as their ids are only meaningful within their session.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.loaded = False
+        self.cursor = 0
+        self.entities = {category: np.empty(0, dtype=np.int32) for category in CATEGORIES}
+        self.seen = np.empty(0, dtype=np.int32)
+        self.other_entities = {category: set() for category in CATEGORIES}
+        self.other_seen = set()
+
+    def add(self, token, session):
+        session = intern_session(session)
+
+        self.sessions[token] = session
+        self._index(session, session[OTHER_URIS])
+
+    def apply(self, token, record):
+        # As apply_record, on interned sessions
+        session = self.sessions[token]
+        record = intern_session(record, session[OTHER_URIS])
+
+        session[SEQUENCE] = last_sequence(session) + 1
+        session[TIMESTAMPS].append(record[TIMESTAMPS])
+        for key in APPENDED_KEYS:
+            if key in record:
+                session[key] = np.concatenate((session[key], record[key]))
+
+        session[FINAL] = record[FINAL]
+        self._index(record, session[OTHER_URIS])
+
+    def _index(self, items, other_uris):
+        for category in CATEGORIES:
+            ids = items.get(category)
+            if ids is None:
+                continue
+
+            uris = {other_uris[-1 - i] for i in ids[ids < 0].tolist()}
+            self.other_entities[category] |= uris
+            self.other_seen |= uris
+
+            ids = ids[ids >= 0]
+            if len(ids):
+                self.entities[category] = np.union1d(self.entities[category], ids)
+                self.seen = np.union1d(self.seen, ids)
+
+
+class SessionStore:
+    """
+    In-memory sessions grouped by user head, so cross-session lookups only touch the user's own history.
+    Sessions are read from and written to a session backend. With a shared backend, every access picks up the
+    interactions other workers have recorded for the user since the last access. Entities are held as entity ids,
+    and are only URIs in the sessions and records exchanged with the backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._users = {}
+
+    def __contains__(self, token):
+        user = self._users.get(get_head(token))
+
+        return user is not None and token in user.sessions
+
+    def user(self, token):
+        head = get_head(token)
+        if head not in self._users:
+            self._users[head] = UserHistory()
+
+        return self._users[head]
+
+    def get(self, token):
+        user = self._users.get(get_head(token))
+
+        return user.sessions.get(token) if user else None
+
+    def export(self, token):
+        """
+        Returns the session of token with URIs, as stored by the backend.
+        """
+        return export_session(self.get(token))
+
+    def load(self, token):
+        """
+        Ensures that all sessions of the token's user are loaded and up to date.
+        """
+        user = self.user(token)
+
+        if not user.loaded:
+            sessions, user.cursor = self.backend.user_sessions(get_head(token))
+            for other, session in sessions.items():
+                if other not in user.sessions:
+                    user.add(other, session)
+
+            user.loaded = True
+        elif self.backend.shared:
+            for event_id, other, version, record in self.backend.user_events(get_head(token), user.cursor):
+                if other not in user.sessions:
+                    user.add(other, new_session(version))
+
+                user.apply(other, json.loads(record))
+                user.cursor = event_id
+
+        return user
+
+    def session(self, token, version):
+        """
+        Returns the session of token, creating it if it does not exist.
+        """
+        user = self.load(token)
+        if token not in user.sessions:
+            if self.backend.shared:
+                # Interactions recorded by other workers are picked up through the user's cursor
+                user.add(token, self.backend.create(token, version))
+                self.load(token)
+            else:
+                user.add(token, self.backend.load(token) or self.backend.create(token, version))
+
+        return user.sessions[token]
+
+    def append(self, token, record):
+        if self.backend.shared:
+            # Apply the record through the backend, so it is ordered with writes from other workers
+            size = self.backend.append(token, record)
+            self.load(token)
+        else:
+            # The session is only exported when the backend compacts it
+            self.user(token).apply(token, record)
+            size = self.backend.append(token, record, self.get(token), lambda: self.export(token))
+
+        return size
+
+    def cross_session_entities(self, token):
+        """
+        Returns the liked, disliked, unknown and seen entities across all sessions of the token's user, each as
+        their ids and the sorted URIs of those outside the entity index.
+        """
+        user = self.load(token)
+
+        return [(user.entities[category], sorted(user.other_entities[category])) for category in CATEGORIES] + \
+            [(user.seen, sorted(user.other_seen))]
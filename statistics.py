@@ -1,24 +1,46 @@
 import csv
 import json
+import threading
+import time
+from bisect import bisect_left, insort
 from collections import Counter
+from heapq import merge
 from os.path import exists
 
 import numpy as np
-from scipy import median, mean, amin, amax, std, percentile
 
-from dataset import movie_uris_set
+from configuration import STATISTICS_SYNC_INTERVAL
+import dataset
 from queries import get_number_entities
-from utility.utilities import get_unique_uuids, get_sessions
+from session_backend import get_backend
+from utility.journal import is_empty, last_sequence
 
-uri_name = dict()
 uri_name_path = 'data/movielens/uri_name.csv'
+_uri_names = {}
 
-if exists(uri_name_path):
-    with open(uri_name_path, 'r') as fp:
-        reader = csv.DictReader(fp)
 
-        for row in reader:
-            uri_name[row['uri']] = row['name']
+def uri_names():
+    """
+    Names of the URIs in the statistics, read on first use.
+    """
+    if 'names' not in _uri_names:
+        names = dict()
+        if exists(uri_name_path):
+            with open(uri_name_path, 'r') as fp:
+                reader = csv.DictReader(fp)
+
+                for row in reader:
+                    names[row['uri']] = row['name']
+
+        _uri_names['names'] = names
+
+    return _uri_names['names']
+
+
+CATEGORIES = ['liked', 'disliked', 'unknown']
+
+# Partition holding the sessions of every version
+ALL_VERSIONS = '*'
 
 
 class NpEncoder(json.JSONEncoder):
@@ -33,214 +55,421 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def get_durations(sessions): 
-    durations = []
-    for session in sessions:
-        timestamps = session['timestamps'] 
-        durations.append(timestamps[-1] - timestamps[0])
-
-    return durations
-
-
-def get_likes(sessions): 
-    likes = []
-    for session in sessions: 
-        likes += session['liked']
-
-    return likes 
-
-
-def get_dislikes(sessions): 
-    dislikes = []
-    for session in sessions: 
-        dislikes += session['disliked']
-
-    return dislikes 
-
-
-def get_unknowns(sessions):
-    unknowns = []
-    for session in sessions: 
-        unknowns += session['unknown']
+class SortedValues:
+    """
+    Sorted list of values with a running mean and variance, so order statistics and moments are read without a scan.
+    """
+
+    def __init__(self, values=()):
+        self.values = sorted(values)
+
+        # Mean and sum of squared deviations, kept up to date with Welford's updates
+        n = len(self.values)
+        self.mean = sum(self.values) / n if n else 0.0
+        self.deviations = sum((value - self.mean) ** 2 for value in self.values)
+
+    def add(self, value):
+        insort(self.values, value)
+
+        delta = value - self.mean
+        self.mean += delta / len(self.values)
+        self.deviations += delta * (value - self.mean)
+
+    def remove(self, value):
+        del self.values[bisect_left(self.values, value)]
+
+        n = len(self.values)
+        if not n:
+            self.mean, self.deviations = 0.0, 0.0
+            return
+
+        delta = value - self.mean
+        self.mean -= delta / n
+        self.deviations -= delta * (value - self.mean)
+
+    def percentile(self, q):
+        # Linear interpolation, as numpy.percentile
+        position = (len(self.values) - 1) * q / 100
+        lower = int(position)
+        upper = min(lower + 1, len(self.values) - 1)
+
+        return self.values[lower] + (self.values[upper] - self.values[lower]) * (position - lower)
+
+    def statistics(self):
+        n = len(self.values)
+        if not n:
+            return None
+
+        return {
+            'min': self.values[0],
+            'max': self.values[-1],
+            'avg': self.mean,
+            'median': self.percentile(50),
+            # Rounding can leave the deviations slightly negative once every value is equal
+            'std': max(0.0, self.deviations / n) ** 0.5,
+            'q1': self.percentile(25),
+            'q3': self.percentile(75)
+        }
 
-    return unknowns  
 
+def _count_movies(uris):
+    return int((dataset.get_catalog().positions(list(uris)) >= 0).sum())
 
-def get_duration_statistics(sessions): 
-    return get_list_statistics(get_durations(sessions))
 
+def summarize(token, session):
+    """
+    Extracts everything a session contributes to the statistics.
+    """
+    timestamps = session['timestamps']
+    rated = set(session['liked'] + session['disliked'])
+    movie_count = _count_movies(rated)
 
-def get_list_statistics(lst):
     return {
-        'min': amin(lst),
-        'max': amax(lst),
-        'avg': mean(lst),
-        'median': median(lst),
-        'std': std(lst),
-        'q1': percentile(lst, 25),
-        'q3': percentile(lst, 75)
+        'head': token.split('+')[0],
+        'version': session.get('version'),
+        'sequence': last_sequence(session),
+        'final': bool(session.get('final')),
+        'empty': is_empty(session),
+        'items': {category: list(session[category]) for category in CATEGORIES},
+        'counts': {category: len(session[category]) for category in CATEGORIES},
+        'movies': {category: _count_movies(session[category]) for category in CATEGORIES},
+        'first_timestamp': timestamps[0] if timestamps else None,
+        'duration': timestamps[-1] - timestamps[0] if timestamps else 0,
+        'rated': rated,
+        'movie_count': movie_count,
+        'other_count': len(rated) - movie_count
     }
 
 
-def get_feedback_statistics(sessions): 
-    likes = [] 
-    dislikes = [] 
-    unknowns = []
-    like_to_dislike_ratios = []
-
-    for session in sessions: 
-        _likes = len(session['liked'])
-        _dislikes = len(session['disliked'])
-        _unknowns = len(session['unknown'])
-        likes.append(_likes)
-        dislikes.append(_dislikes)
-        unknowns.append(_unknowns)
-
-        if _dislikes:
-            like_to_dislike_ratios.append(_likes / _dislikes)
+def extend_summary(summary, record):
+    """
+    Applies the next record of a session to its summary, in place. Returns the items and the movie counts the record
+    added, so only they need to be counted.
+    """
+    added = {category: list(record.get(category, [])) for category in CATEGORIES}
+    movies = {category: _count_movies(added[category]) for category in CATEGORIES}
+
+    for category in CATEGORIES:
+        summary['items'][category].extend(added[category])
+        summary['counts'][category] += len(added[category])
+        summary['movies'][category] += movies[category]
+
+    timestamp = record['timestamps']
+    if summary['first_timestamp'] is None:
+        summary['first_timestamp'] = timestamp
+
+    rated = set(added['liked'] + added['disliked']) - summary['rated']
+    movie_count = _count_movies(rated)
+    summary['rated'] |= rated
+
+    summary.update({
+        'sequence': summary['sequence'] + 1,
+        'final': bool(record.get('final')),
+        'empty': summary['empty'] and not any(added.values()),
+        'duration': timestamp - summary['first_timestamp'],
+        'movie_count': summary['movie_count'] + movie_count,
+        'other_count': summary['other_count'] + len(rated) - movie_count
+    })
+
+    return added, movies
+
+
+class Partition:
+    """
+    Statistics of one version, over either all or only completed sessions.
+    """
+    LISTS = ['durations', 'likes', 'dislikes', 'unknowns', 'like_to_dislike_ratios', 'movie_counts',
+             'other_counts', 'total_counts']
+
+    def __init__(self, completed):
+        self.completed = completed
+        self.n_sessions = 0
+        self.users = Counter()
+        self.movie_feedback = Counter()
+        self.feedback = Counter()
+        self.lists = {name: SortedValues() for name in self.LISTS}
+        self.top = {category: Counter() for category in CATEGORIES}
+        self.entities = Counter()
+        self.rated = Counter()
+
+    def _has_user(self, summary):
+        # Completed users are counted from final sessions, even when they are empty
+        return summary['final'] if self.completed else not summary['empty']
+
+    def _has_session(self, summary):
+        return not summary['empty'] and (summary['final'] or not self.completed)
+
+    @staticmethod
+    def _lists(summary):
+        likes, dislikes, unknowns = [summary['counts'][category] for category in CATEGORIES]
+
+        values = {
+            'durations': [summary['duration']],
+            'likes': [likes],
+            'dislikes': [dislikes],
+            'unknowns': [unknowns],
+            'like_to_dislike_ratios': [likes / dislikes] if dislikes else [],
+            'movie_counts': [summary['movie_count']],
+            'other_counts': [summary['other_count']],
+            'total_counts': [summary['movie_count'] + summary['other_count']]
+        }
 
-    return {
-        key: get_list_statistics(lst) for key, lst in {
-            'likes': likes,
-            'dislikes': dislikes,
-            'unknowns': unknowns,
-            'like_to_dislike_ratios': like_to_dislike_ratios
-        }.items()
-    }
+        return values.items()
+
+    def _update_user(self, summary, sign):
+        if self._has_user(summary):
+            self.users[summary['head']] += sign
+            if self.users[summary['head']] <= 0:
+                del self.users[summary['head']]
+
+    def _update_lists(self, summary, sign):
+        self.n_sessions += sign
+
+        for name, values in self._lists(summary):
+            for value in values:
+                (self.lists[name].add if sign > 0 else self.lists[name].remove)(value)
+
+    def _update_items(self, items, movies, sign):
+        for category in CATEGORIES:
+            self.feedback[category] += sign * len(items[category])
+            self.movie_feedback[category] += sign * movies[category]
+
+            counters = [self.top[category], self.entities] + ([self.rated] if category != 'unknown' else [])
+            for counter in counters:
+                for item, count in Counter(items[category]).items():
+                    counter[item] += sign * count
+                    if counter[item] <= 0:
+                        del counter[item]
+
+    def update(self, summary, sign=1):
+        self._update_user(summary, sign)
+
+        if self._has_session(summary):
+            self._update_lists(summary, sign)
+            self._update_items(summary['items'], summary['movies'], sign)
+
+    def change(self, before, after, added, movies):
+        """
+        Replaces the summary of a session by the one extend_summary made of it, given a copy of the summary before
+        (whose items are already those of after) and what the record added.
+        """
+        self._update_user(before, -1)
+        self._update_user(after, 1)
+
+        was_included, included = self._has_session(before), self._has_session(after)
+        if was_included:
+            self._update_lists(before, -1)
+        if included:
+            self._update_lists(after, 1)
+
+        if was_included and included:
+            self._update_items(added, movies, 1)
+        elif included:
+            self._update_items(after['items'], after['movies'], 1)
+        elif was_included:
+            # The items of before are those of after, less the ones the record added
+            self._update_items(after['items'], after['movies'], -1)
+            self._update_items(added, movies, 1)
+
+    @classmethod
+    def merged(cls, partitions):
+        """
+        Combines the partitions of several versions into one.
+        """
+        result = cls(partitions[0].completed)
+        for partition in partitions:
+            result.n_sessions += partition.n_sessions
+            result.users.update(partition.users)
+            result.movie_feedback.update(partition.movie_feedback)
+            result.feedback.update(partition.feedback)
+            result.entities.update(partition.entities)
+            result.rated.update(partition.rated)
+
+            for category in CATEGORIES:
+                result.top[category].update(partition.top[category])
+
+        for name in cls.LISTS:
+            result.lists[name] = SortedValues(merge(*[partition.lists[name].values for partition in partitions]))
+
+        return result
+
+    def statistics(self, number_entities):
+        feedback = {
+            'movies': self.movie_feedback,
+            'non_movies': {category: self.feedback[category] - self.movie_feedback[category] for category in CATEGORIES},
+            'entities': self.feedback
+        }
 
+        return {
+            'n_sessions': self.n_sessions,
+            'n_users': len(self.users),
+            'distributions': {key: get_feedback_distribution(counts) for key, counts in feedback.items()},
+            'durations': self.lists['durations'].statistics(),
+            'feedback': {
+                key: self.lists[key].statistics() for key in ['likes', 'dislikes', 'unknowns', 'like_to_dislike_ratios']
+            },
+            'top': {
+                category: [{'uri': uri, 'count': count,
+                            'name': uri_names().get(uri, 'N/A')}
+                           for uri, count in self.top[category].most_common(10)]
+                for category in CATEGORIES
+            },
+            'n_entities': len(self.entities),
+            'rated_rate': len(self.rated) / (number_entities * 1.0),
+            'n_ratings': {
+                'session': {
+                    'movies': self.lists['movie_counts'].statistics(),
+                    'others': self.lists['other_counts'].statistics(),
+                    'total': self.lists['total_counts'].statistics()
+                }
+            }
+        }
 
-def get_top_entities(session_set):
-    categories = {'liked', 'disliked', 'unknown'}
-    category_items = {key: [] for key in categories}
 
-    for session in session_set:
-        for category in categories:
-            category_items[category] += session[category]
+def get_feedback_distribution(counts):
+    n_liked, n_disliked, n_unknown = [counts[category] for category in CATEGORIES]
+    n_total = n_liked + n_disliked + n_unknown
 
     return {
-        category: [{'uri': uri, 'count': count,
-                    'name': uri_name.get(uri, 'N/A')} for uri, count in Counter(items).most_common(10)]
-
-        for category, items in category_items.items()
+        'n_total': n_total,
+        'n_liked': n_liked,
+        'n_disliked': n_disliked,
+        'n_unknown': n_unknown,
+        'p_liked': n_liked / n_total if n_total else 0,
+        'p_disliked': n_disliked / n_total if n_total else 0,
+        'p_unknown': n_unknown / n_total if n_total else 0
     }
 
 
-def get_unique_entities(session_set):
-    categories = {'liked', 'disliked', 'unknown'}
-    items = get_entities_set_from_categories(session_set, categories)
+class StatisticsAggregator:
+    """
+    Maintains session statistics per version, for all and for completed sessions. Sessions are scanned once,
+    after which the statistics are updated with every record written. Sessions written by other workers are picked
+    up from the backend's change feed at most every STATISTICS_SYNC_INTERVAL seconds.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.ready = False
+        self._summaries = {}
+        self._partitions = {}
+        self._number_entities = None
+        self._cursor = None
+        self._synced = 0
+        self._lock = threading.RLock()
+
+    def _partitions_of(self, summary):
+        for version in [ALL_VERSIONS, summary['version']]:
+            for completed in [False, True]:
+                key = (version, completed)
+                if key not in self._partitions:
+                    self._partitions[key] = Partition(completed)
 
-    return len(items)
+                yield self._partitions[key]
 
+    def build(self):
+        with self._lock:
+            if self.ready:
+                return
 
-def _filter(uris, only_movies=False, only_non_movies=False):
-    if only_movies:
-        return [uri for uri in uris if uri in movie_uris_set]
-    elif only_non_movies:
-        return [uri for uri in uris if uri not in movie_uris_set]
+            self._cursor = self.backend.cursor()
+            self._synced = time.time()
+            for token, session in self.backend.iter_sessions():
+                self._update(token, session)
 
-    return uris
+            self.ready = True
 
+    def _update(self, token, session):
+        previous = self._summaries.get(token)
+        if previous:
+            for partition in self._partitions_of(previous):
+                partition.update(previous, sign=-1)
 
-def get_entity_rated_rate(session_set):
-    categories = {'liked', 'disliked'}
-    items = get_entities_set_from_categories(session_set, categories)
+        summary = summarize(token, session)
+        for partition in self._partitions_of(summary):
+            partition.update(summary)
 
-    num = get_number_entities()
+        self._summaries[token] = summary
 
-    return len(items) / (num * 1.0)
+    def apply(self, token, record, sequence):
+        """
+        Counts a record written to a session, which sequence records make up with it. Sessions whose summary does
+        not end right before the record, such as new ones, are read from the backend instead.
+        """
+        with self._lock:
+            # Until the first scan, every session is read from the backend anyway
+            if not self.ready:
+                return
 
+            summary = self._summaries.get(token)
+            if summary is not None and summary['sequence'] >= sequence:
+                # Already read from the backend with the record
+                return
 
-def get_entities_set_from_categories(session_set, categories):
-    items = list()
-    for session in session_set:
-        for category in categories:
-            items += session[category]
+            if summary is None or summary['sequence'] != sequence - 1:
+                session = self.backend.load(token)
+                if session:
+                    self._update(token, session)
 
-    return set(items)
+                return
 
+            before = dict(summary, counts=dict(summary['counts']), movies=dict(summary['movies']))
+            added, movies = extend_summary(summary, record)
+            for partition in self._partitions_of(summary):
+                partition.change(before, summary, added, movies)
 
-def get_movie_ratings(session_set):
-    movie_counts = []
-    other_counts = []
-    total_counts = []
+    def sync(self):
+        with self._lock:
+            if time.time() - self._synced < STATISTICS_SYNC_INTERVAL:
+                return
 
-    for session in session_set:
-        rated = set(session['liked'] + session['disliked'])
+            tokens, self._cursor = self.backend.changes(self._cursor)
+            self._synced = time.time()
 
-        movie_count = len(_filter(rated, only_movies=True))
-        other_count = len(_filter(rated, only_non_movies=True))
+            for token in tokens:
+                session = self.backend.load(token)
+                if session:
+                    self._update(token, session)
 
-        movie_counts.append(movie_count)
-        other_counts.append(other_count)
-        total_counts.append(movie_count + other_count)
+    def number_entities(self):
+        # The graph only changes on import, so it is counted once
+        if self._number_entities is None:
+            self._number_entities = get_number_entities()
 
-    return {
-        'movies': get_list_statistics(movie_counts),
-        'others': get_list_statistics(other_counts),
-        'total': get_list_statistics(total_counts)
-    }
+        return self._number_entities
 
+    def statistics(self, versions=None):
+        self.build()
+        self.sync()
+
+        with self._lock:
+            keys = versions if versions else [ALL_VERSIONS]
+            result = {}
+            for name, completed in {'all': False, 'completed': True}.items():
+                partitions = [self._partitions[(key, completed)] for key in keys if (key, completed) in self._partitions]
+                if not partitions:
+                    return None
 
-def get_feedback_distribution(session_set, only_movies=False, only_non_movies=False):
-    n_total, n_liked, n_disliked, n_unknown = 0, 0, 0, 0
+                partition = partitions[0] if len(partitions) == 1 else Partition.merged(partitions)
+                result[name] = partition
 
-    for session in session_set: 
-        uris = _filter(session['liked'], only_movies=only_movies, only_non_movies=only_non_movies)
-        n_liked += len(uris)
+            if not result['all'].n_sessions:
+                return None
 
-        uris = _filter(session['disliked'], only_movies=only_movies, only_non_movies=only_non_movies)
-        n_disliked += len(uris)
+            return {name: partition.statistics(self.number_entities()) for name, partition in result.items()}
 
-        uris = _filter(session['unknown'], only_movies=only_movies, only_non_movies=only_non_movies)
-        n_unknown += len(uris)
 
-    n_total = n_liked + n_disliked + n_unknown
-    
-    return {
-        'n_total': n_total,
-        'n_liked': n_liked,
-        'n_disliked': n_disliked,
-        'n_unknown': n_unknown,
-        'p_liked': n_liked / n_total,
-        'p_disliked': n_disliked / n_total,
-        'p_unknown': n_unknown / n_total
-    }
+aggregator = StatisticsAggregator(get_backend())
 
 
-def compute_statistics(versions=None):
-    unique_tokens_not_empty = get_unique_uuids(filter_empty=True, versions=versions)
-    unique_tokens_final = get_unique_uuids(filter_final=True, versions=versions)
-    
-    sessions = get_sessions(filter_empty=True, versions=versions)
-    if not sessions:
-        return None
-    completed_sessions = [session for session in sessions if session['final']]
-
-    statistics = {
-        key: {
-            'n_sessions': len(session_set),
-            'n_users': len(unique_tokens_not_empty if key == 'all' else unique_tokens_final),
-            'distributions': {
-                'movies': get_feedback_distribution(session_set, only_movies=True),
-                'non_movies': get_feedback_distribution(session_set, only_non_movies=True),
-                'entities': get_feedback_distribution(session_set)
-            },
-            'durations': get_duration_statistics(session_set),
-            'feedback': get_feedback_statistics(session_set),
-            'top': get_top_entities(session_set),
-            'n_entities': get_unique_entities(session_set),
-            'rated_rate': get_entity_rated_rate(session_set),
-            'n_ratings': {
-                'session': get_movie_ratings(session_set)
-            }
-        }
-        for key, session_set in {'all': sessions, 'completed': completed_sessions}.items()
-    }
+def record_interaction(token, record, sequence):
+    aggregator.apply(token, record, sequence)
 
-    return statistics
 
+def compute_statistics(versions=None):
+    return aggregator.statistics(versions)
 
-if __name__ == '__main__': 
-    with open('statistics.json', 'w+') as fp: 
-        json.dump(compute_statistics(), fp, cls=NpEncoder, indent=True)
 
+if __name__ == '__main__':
+    with open('statistics.json', 'w+') as fp:
+        json.dump(compute_statistics(), fp, cls=NpEncoder, indent=True)
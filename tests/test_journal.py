@@ -0,0 +1,92 @@
+import json
+import os
+
+from configuration import SEQUENCE
+from utility.journal import create_session, append_record, load_session, apply_record, write_snapshot, \
+    make_record, journal_path, snapshot_path
+
+
+def _append(path, token, session, timestamp, liked):
+    record = make_record(timestamp, liked, [], [], [], False)
+    apply_record(session, record)
+    append_record(path, token, record, session)
+
+    return session
+
+
+def test_replays_journal_on_snapshot(tmp_path):
+    session = create_session(tmp_path, 'a+1', 'v')
+    for timestamp in range(3):
+        _append(tmp_path, 'a+1', session, timestamp, [f'uri-{timestamp}'])
+
+    assert load_session(tmp_path, 'a+1') == session
+    assert load_session(tmp_path, 'missing+1') is None
+
+
+def test_skips_partial_last_line(tmp_path):
+    session = create_session(tmp_path, 'a+1', 'v')
+    _append(tmp_path, 'a+1', session, 1, ['uri-1'])
+
+    # An append interrupted halfway through its line
+    with open(journal_path(tmp_path, 'a+1'), 'a') as fp:
+        fp.write('{"timestamps":2,"final":false,"liked":["uri-')
+
+    loaded = load_session(tmp_path, 'a+1')
+    assert loaded['liked'] == ['uri-1']
+    assert loaded[SEQUENCE] == 1
+
+
+def test_skips_records_in_snapshot_by_sequence(tmp_path):
+    session = create_session(tmp_path, 'a+1', 'v')
+    _append(tmp_path, 'a+1', session, 5, ['uri-1'])
+    _append(tmp_path, 'a+1', session, 5, ['uri-2'])
+
+    # The snapshot holds the first record, and the second record has the same timestamp
+    snapshot = json.loads(json.dumps(session))
+    snapshot['liked'], snapshot['timestamps'], snapshot[SEQUENCE] = ['uri-1'], [5], 1
+    write_snapshot(tmp_path, 'a+1', snapshot)
+
+    assert load_session(tmp_path, 'a+1')['liked'] == ['uri-1', 'uri-2']
+
+
+def test_recovers_from_interrupted_compaction(tmp_path):
+    session = create_session(tmp_path, 'a+1', 'v')
+    _append(tmp_path, 'a+1', session, 1, ['uri-1'])
+    _append(tmp_path, 'a+1', session, 2, ['uri-2'])
+
+    # Compaction wrote the snapshot, but stopped before removing the journal
+    write_snapshot(tmp_path, 'a+1', session)
+    assert os.path.exists(journal_path(tmp_path, 'a+1'))
+
+    _append(tmp_path, 'a+1', session, 3, ['uri-3'])
+
+    loaded = load_session(tmp_path, 'a+1')
+    assert loaded['liked'] == ['uri-1', 'uri-2', 'uri-3']
+    assert loaded[SEQUENCE] == 3
+    assert loaded == session
+
+
+def test_compacts_past_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr('utility.journal.JOURNAL_COMPACT_BYTES', 200)
+
+    session = create_session(tmp_path, 'a+1', 'v')
+    for timestamp in range(10):
+        _append(tmp_path, 'a+1', session, timestamp, [f'uri-{timestamp}'])
+
+    with open(snapshot_path(tmp_path, 'a+1')) as fp:
+        assert json.load(fp)[SEQUENCE] > 0
+
+    assert load_session(tmp_path, 'a+1') == session
+
+
+def test_skips_older_unnumbered_records_by_timestamp(tmp_path):
+    session = create_session(tmp_path, 'a+1', 'v')
+    _append(tmp_path, 'a+1', session, 1, ['uri-1'])
+    write_snapshot(tmp_path, 'a+1', {key: value for key, value in session.items() if key != SEQUENCE})
+
+    # Records written before they were numbered
+    with open(journal_path(tmp_path, 'a+1'), 'w') as fp:
+        for record in [make_record(1, ['uri-1'], [], [], [], False), make_record(2, ['uri-2'], [], [], [], False)]:
+            fp.write(json.dumps(record) + '\n')
+
+    assert load_session(tmp_path, 'a+1')['liked'] == ['uri-1', 'uri-2']
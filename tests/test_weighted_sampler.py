@@ -0,0 +1,60 @@
+import numpy as np
+
+from utility.weighted_sampler import WeightedSampler
+
+
+def test_never_returns_excluded_positions():
+    sampler = WeightedSampler(np.arange(1, 101), seed=1)
+
+    # Few excluded positions are rejected on draw, most of the weight is masked instead
+    for exclude in [[99, 98, 3], list(range(20, 100))]:
+        for _ in range(50):
+            result = sampler.sample(10, exclude)
+            assert len(result) == 10
+            assert not set(result.tolist()) & set(exclude)
+
+
+def test_returns_distinct_positions():
+    sampler = WeightedSampler([5, 1, 0, 3, 2, 8], seed=2)
+
+    result = sampler.sample(10)
+    assert sorted(result.tolist()) == [0, 1, 3, 4, 5]
+
+    result = sampler.sample(3, [0, 5])
+    assert len(set(result.tolist())) == 3
+    assert set(result.tolist()) <= {1, 3, 4}
+
+
+def test_leaves_weights_unchanged():
+    weights = [5.0, 1.0, 3.0, 2.0]
+    sampler = WeightedSampler(weights, seed=3)
+    sampler.sample(3, [1])
+
+    assert sampler.weights.tolist() == weights
+    assert sampler.total() == sum(weights)
+
+
+def test_draws_proportionally_to_weights():
+    weights = np.array([1, 2, 3, 4])
+    sampler = WeightedSampler(weights, seed=4)
+
+    draws = np.concatenate([sampler.sample(1) for _ in range(20000)])
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+
+    assert np.allclose(frequencies, weights / weights.sum(), atol=0.01)
+
+
+def test_draws_proportionally_without_excluded():
+    weights = np.array([1, 2, 3, 4])
+    sampler = WeightedSampler(weights, seed=5)
+
+    draws = np.concatenate([sampler.sample(1, [3]) for _ in range(20000)])
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+
+    assert np.allclose(frequencies, [1 / 6, 2 / 6, 3 / 6, 0], atol=0.01)
+
+
+def test_is_reproducible_with_a_seed():
+    first, second = WeightedSampler(np.arange(1, 50), seed=6), WeightedSampler(np.arange(1, 50), seed=6)
+
+    assert first.sample(10, [4, 5]).tolist() == second.sample(10, [4, 5]).tolist()
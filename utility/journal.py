@@ -0,0 +1,219 @@
+import json
+import os
+from os.path import join, exists
+
+from configuration import LIKED, DISLIKED, UNKNOWN, TIMESTAMPS, POPULARITY, FINAL, VERSION, SEQUENCE, \
+    JOURNAL_COMPACT_BYTES
+
+SNAPSHOT_EXTENSION = '.json'
+JOURNAL_EXTENSION = '.journal'
+
+# Keys of a session that are extended (rather than overwritten) by every interaction
+APPENDED_KEYS = [LIKED, DISLIKED, UNKNOWN, POPULARITY]
+
+
+def snapshot_path(path, token):
+    return join(path, f'{token}{SNAPSHOT_EXTENSION}')
+
+
+def journal_path(path, token):
+    return join(path, f'{token}{JOURNAL_EXTENSION}')
+
+
+def _mtime(file):
+    try:
+        return os.stat(file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def session_mtimes(path, token):
+    """
+    Modification times (in nanoseconds) of the snapshot and journal of a session, None for a missing file.
+    """
+    return _mtime(snapshot_path(path, token)), _mtime(journal_path(path, token))
+
+
+def new_session(version):
+    return {
+        LIKED: [],
+        DISLIKED: [],
+        UNKNOWN: [],
+        TIMESTAMPS: [],
+        POPULARITY: [],
+        FINAL: False,
+        VERSION: version,
+        SEQUENCE: 0
+    }
+
+
+def make_record(timestamp, liked, disliked, unknown, popularity_sampled, final):
+    record = {TIMESTAMPS: timestamp, FINAL: final}
+
+    for key, items in zip(APPENDED_KEYS, [liked, disliked, unknown, popularity_sampled]):
+        if items:
+            record[key] = list(items)
+
+    return record
+
+
+def last_sequence(session):
+    """
+    Number of records applied to a session. Sessions written before records were numbered have one timestamp per
+    record.
+    """
+    return session.get(SEQUENCE, len(session[TIMESTAMPS]))
+
+
+def apply_record(session, record):
+    session[SEQUENCE] = last_sequence(session) + 1
+    session[TIMESTAMPS].append(record[TIMESTAMPS])
+    for key in APPENDED_KEYS:
+        session[key] += record.get(key, [])
+
+    session[FINAL] = record[FINAL]
+
+
+def is_empty(session):
+    # By length, so sessions holding arrays of entity ids qualify as well
+    return not (len(session[LIKED]) or len(session[DISLIKED]) or len(session[UNKNOWN]))
+
+
+def matches(session, filter_final=False, filter_empty=False, versions=None):
+    """
+    Whether a session passes the filters of the session exports.
+    """
+    if versions and session.get(VERSION) not in versions:
+        return False
+
+    if filter_final and not session.get(FINAL):
+        return False
+
+    return not (filter_empty and is_empty(session))
+
+
+def session_tokens(path):
+    """
+    Lists the tokens of all sessions in path. Every session has a snapshot, which is written when it is created.
+    """
+    return [name[:-len(SNAPSHOT_EXTENSION)] for name in os.listdir(path) if name.endswith(SNAPSHOT_EXTENSION)]
+
+
+def token_chunks(path, chunk_size):
+    """
+    Lists the tokens of all sessions in path in chunks, in the order of session_tokens, without holding the whole
+    listing in memory.
+    """
+    chunk = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(SNAPSHOT_EXTENSION):
+                chunk.append(entry.name[:-len(SNAPSHOT_EXTENSION)])
+
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def load_sessions(path, tokens, filters):
+    """
+    Loads a chunk of sessions, returning the token of every session and the session itself if it passes filters
+    (the arguments of matches), or None otherwise. Sessions deleted since they were listed are left out.
+    """
+    sessions = []
+    for token in tokens:
+        session = load_session(path, token)
+
+        if session is not None:
+            sessions.append((token, session if matches(session, *filters) else None))
+
+    return sessions
+
+
+def load_session(path, token):
+    """
+    Loads the snapshot of a session and replays its journal on top of it.
+    Returns None if the session does not exist.
+    """
+    snapshot = snapshot_path(path, token)
+    if not exists(snapshot):
+        return None
+
+    with open(snapshot, 'r') as fp:
+        session = json.load(fp)
+
+    journal = journal_path(path, token)
+    if not exists(journal):
+        return session
+
+    # Records already folded into the snapshot are skipped, in case compaction was interrupted. Records are numbered,
+    # so that this does not depend on the clock, and only older records are compared by timestamp
+    sequence = last_sequence(session)
+    last_timestamp = session[TIMESTAMPS][-1] if session[TIMESTAMPS] else None
+
+    with open(journal, 'r') as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash during an append can leave a partial last line
+                continue
+
+            if SEQUENCE in record:
+                if record[SEQUENCE] <= sequence:
+                    continue
+            elif last_timestamp is not None and record[TIMESTAMPS] <= last_timestamp:
+                continue
+
+            apply_record(session, record)
+
+    return session
+
+
+def write_snapshot(path, token, session):
+    snapshot = snapshot_path(path, token)
+    temporary = f'{snapshot}.tmp'
+
+    with open(temporary, 'w') as fp:
+        json.dump(session, fp, indent=True)
+
+    os.replace(temporary, snapshot)
+
+
+def create_session(path, token, version):
+    session = new_session(version)
+    write_snapshot(path, token, session)
+
+    return session
+
+
+def append_record(path, token, record, session, snapshot=None):
+    """
+    Appends a record to the journal of a session, numbered after the records before it. Once the journal grows past
+    JOURNAL_COMPACT_BYTES, the session (which must already include the record) is compacted into a new snapshot,
+    which snapshot() returns instead when the session is held in another form.
+    """
+    record = dict(record)
+    record[SEQUENCE] = last_sequence(session)
+
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+
+    fd = os.open(journal_path(path, token), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+    if size >= JOURNAL_COMPACT_BYTES:
+        compact(path, token, snapshot() if snapshot else session)
+
+    return len(line)
+
+
+def compact(path, token, session):
+    write_snapshot(path, token, session)
+    os.remove(journal_path(path, token))
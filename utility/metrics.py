@@ -0,0 +1,152 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in key]
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        bucket = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            series[0][bucket] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative))
+
+            samples.append((f'{self.name}_sum', key, total))
+            samples.append((f'{self.name}_count', key, cumulative))
+
+        return samples
+
+
+class Gauge:
+    """
+    Value read when the metrics are rendered, from a function returning either a number or a dict of labels
+    (as tuples of pairs) to numbers. Counters kept elsewhere, such as by a cache, are exposed the same way.
+    """
+
+    def __init__(self, name, documentation, collect, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        return [(self.name, key, value) for key, value in values.items() if value is not None]
+
+
+class Registry:
+    """
+    Metrics of this process, rendered in the Prometheus text format. Every worker keeps its own, so a scrape
+    reports the worker that served it.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def gauge(self, name, documentation, collect, kind='gauge'):
+        return self._register(Gauge(name, documentation, collect, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+
+            for name, key, value in metric.samples():
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class QueryScheduler:
+    """
+    Runs queries on a fixed pool of threads shared by all requests. Every call has a deadline after which the caller
+    stops waiting and falls back, and calls that have not started by then are cancelled. At most max_pending calls
+    wait for a thread, further calls fall back immediately.
+    """
+
+    # How many of the latest wait times are kept for the statistics
+    WINDOW = 1024
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=self.WINDOW)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query')
+        self._lock = threading.Lock()
+
+    def _run(self, submitted, deadline, fn, args):
+        started = time.monotonic()
+        with self._lock:
+            self.pending -= 1
+            self._waits.append(started - submitted)
+
+            # The caller has already fallen back, so there is no point in starting
+            if deadline is not None and started >= deadline:
+                self.cancelled += 1
+                return None
+
+            self.running += 1
+
+        try:
+            result = fn(*args)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                self.completed += 1
+        finally:
+            with self._lock:
+                self.running -= 1
+
+        return result
+
+    def run(self, fn, *args, timeout=None, fallback=None):
+        """
+        Returns fn(*args), or the result of fallback() (None without one) when it does not finish within timeout
+        seconds or the queue is full. The fallback is called on the calling thread.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return fallback() if fallback else None
+
+            self.pending += 1
+
+        submitted = time.monotonic()
+        deadline = submitted + timeout if timeout is not None else None
+        future = self._executor.submit(self._run, submitted, deadline, fn, args)
+
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+
+                if future.cancel():
+                    self.pending -= 1
+                    self.cancelled += 1
+
+            return fallback() if fallback else None
+
+    def statistics(self):
+        with self._lock:
+            waits = sorted(self._waits)
+
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                'cancelled': self.cancelled,
+                'rejected': self.rejected,
+                'wait': {
+                    'avg': sum(waits) / len(waits),
+                    'median': waits[len(waits) // 2],
+                    'p95': waits[int(len(waits) * 0.95)],
+                    'max': waits[-1]
+                } if waits else None
+            }
@@ -1,62 +1,100 @@
 import itertools
-import json
-import os
-from os.path import join
 
-from pandas import DataFrame
 from tqdm import tqdm
 
-from dataset import movie_uris_set
+import dataset
+from session_backend import get_backend
+from utility.journal import matches
 
-SESSIONS_PATH = 'sessions'
 RATINGS_MAP = {'liked': 1, 'disliked': -1, 'unknown': 0}
+RATING_COLUMNS = ['userId', 'uri', 'isItem', 'sentiment']
 
 
-def get_ratings_dataframe(final_only=False, versions=None):
-    return DataFrame(get_user_entity_pairs(final_only, versions))
+def ratings_cursor():
+    """
+    Returns the cursor to pass as since to pick up the sessions written from now on. Take it before reading the
+    ratings, so that sessions written while they are read are picked up again rather than missed.
+    """
+    return get_backend().cursor()
 
 
-def get_user_entity_pairs(final_only=False, versions=None):
-    user_uri_ratings = get_ratings(filter_final=final_only, filter_empty=True, versions=versions)
+def changed_users(since):
+    """
+    Returns the users with sessions written since a cursor, and the cursor to pass on the next call.
+    """
+    tokens, cursor = get_backend().changes(since)
 
-    user_entity_pairs = {'userId': [], 'uri': [], 'isItem': [], 'sentiment': []}
+    return {token.split('+')[0] for token in tokens}, cursor
+
+
+def iter_user_entity_pairs(final_only=False, versions=None, users=None):
+    """
+    Yields the userId, uri, isItem and sentiment of every rating, of only the given users if any. Whether a URI is
+    a movie is looked up once per distinct URI.
+
+    Given users, their ratings are preceded by a row with an empty uri and no sentiment for each of them, telling
+    clients to drop the ratings they hold of that user, even if it has none left.
+    """
+    user_uri_ratings = get_ratings(filter_final=final_only, filter_empty=True, versions=versions, users=users)
+
+    for user in sorted(users or []):
+        yield user, '', False, None
+
+    uris = list({uri for rating_uris in user_uri_ratings.values() for uris in rating_uris.values() for uri in uris})
+    is_item = dict(zip(uris, (dataset.get_catalog().positions(uris) >= 0).tolist()))
 
     for user, rating_uris in user_uri_ratings.items():
         for rating, uris in rating_uris.items():
             for uri in uris:
-                user_entity_pairs['userId'].append(user)
-                user_entity_pairs['sentiment'].append(RATINGS_MAP[rating])
-                user_entity_pairs['uri'].append(uri)
-                user_entity_pairs['isItem'].append(uri in movie_uris_set)
+                yield user, uri, is_item[uri], RATINGS_MAP[rating]
+
+
+def get_user_entity_pairs(final_only=False, versions=None, since=None):
+    """
+    Returns the ratings as lists per column. With a cursor from ratings_cursor as since, only the ratings of users
+    whose sessions changed since then are returned, which replace all previous ratings of these users, after one
+    row with an empty uri per changed user.
+    """
+    users = changed_users(since)[0] if since is not None else None
+    user_entity_pairs = {column: [] for column in RATING_COLUMNS}
+
+    for row in iter_user_entity_pairs(final_only, versions, users):
+        for column, value in zip(RATING_COLUMNS, row):
+            user_entity_pairs[column].append(value)
 
     return user_entity_pairs
 
 
-def get_ratings(filter_final=False, filter_empty=False, versions=None):
+def _user_sessions(users, filters):
+    backend = get_backend()
+
+    for user in sorted(users):
+        for token, session in backend.user_sessions(user)[0].items():
+            yield token, session if matches(session, *filters) else None
+
+
+def get_ratings(filter_final=False, filter_empty=False, versions=None, users=None):
     uuid_sessions = {}
     categories = ['liked', 'disliked', 'unknown']
 
+    if users is None:
+        sessions = get_backend().scan(filter_final, filter_empty, versions)
+    else:
+        # Only the sessions of the given users are read
+        sessions = _user_sessions(users, (filter_final, filter_empty, versions))
+
     # Combine user sessions
-    for session_id in tqdm(os.listdir(SESSIONS_PATH)):
+    for session_id, session in tqdm(sessions):
         uuid = session_id.split('+')[0]
 
         if uuid not in uuid_sessions:
             uuid_sessions[uuid] = {'liked': set(), 'disliked': set(), 'unknown': set()}
 
-        with open(join(SESSIONS_PATH, session_id)) as fp:
-            session = json.load(fp)
-
-            if versions:
-                if 'version' not in session or session['version'] not in versions:
-                    continue
+        # Filtered out
+        if session is None:
+            continue
 
-            if filter_final and ('final' not in session or not session['final']):
-                continue
-
-            if filter_empty and is_empty(session):
-                continue
-
-            [uuid_sessions[uuid][key].update(set(item)) for key, item in session.items() if key in categories and item]
+        [uuid_sessions[uuid][key].update(set(item)) for key, item in session.items() if key in categories and item]
 
     # Generate all 2-length combinations of categories
     category_combinations = list(itertools.combinations(categories, 2))
@@ -75,49 +113,14 @@ def get_ratings(filter_final=False, filter_empty=False, versions=None):
 
 
 def get_sessions(filter_empty=True, versions=None):
-    sessions = []
-    for session_id in os.listdir(SESSIONS_PATH):
-        with open(join(SESSIONS_PATH, session_id)) as fp:
-            session = json.load(fp)
-
-            if filter_empty:
-                if is_empty(session):
-                    continue
-
-            if versions:
-                if 'version' not in session or session['version'] not in versions:
-                    continue
-
-            sessions.append(session)
-
-    return sessions
+    return [session for _, session in get_backend().scan(filter_empty=filter_empty, versions=versions)
+            if session is not None]
 
 
 def get_unique_uuids(filter_final=False, filter_empty=False, versions=None):
     if filter_final or filter_empty or versions:
-        tokens = []
-        for session_id in os.listdir(SESSIONS_PATH):
-            with open(join(SESSIONS_PATH, session_id)) as fp:
-                session = json.load(fp)
-
-                if filter_empty:
-                    if is_empty(session):
-                        continue
-
-                if filter_final:
-                    if not session['final']:
-                        continue
-
-                if versions:
-                    if 'version' not in session or session['version'] not in versions:
-                        continue
-
-                tokens.append(session_id)
-
-        return set([token.replace('.json', '').split('+')[0] for token in tokens])
-
-    return set([token.replace('.json', '').split('+')[0] for token in os.listdir(SESSIONS_PATH)])
+        tokens = get_backend().matching_tokens(filter_final, filter_empty, versions)
 
+        return set([token.split('+')[0] for token in tokens])
 
-def is_empty(session):
-    return not (session['liked'] or session['disliked'] or session['unknown'])
+    return set([token.split('+')[0] for token in get_backend().tokens()])
@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+
+
+class Warmup:
+    """
+    Runs the slow initialization tasks of a worker concurrently in the background, retrying failed tasks every
+    retry_interval seconds until they succeed. The worker is ready once every task has succeeded.
+    """
+
+    def __init__(self, tasks, retry_interval):
+        self.tasks = tasks
+        self.retry_interval = retry_interval
+        self.status = {name: 'pending' for name in tasks}
+        self.errors = {}
+        self.durations = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Threads do not survive a fork, so workers forked from a preloaded master start their own
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+
+        for name, task in self.tasks.items():
+            if self.status[name] != 'ready':
+                threading.Thread(target=self._run, args=(name, task), name=f'warmup-{name}', daemon=True).start()
+
+    def _run(self, name, task):
+        while True:
+            started = time.time()
+
+            try:
+                task()
+            except Exception as e:
+                self.status[name] = 'failed'
+                self.errors[name] = repr(e)
+
+                time.sleep(self.retry_interval)
+            else:
+                self.status[name] = 'ready'
+                self.durations[name] = time.time() - started
+                self.errors.pop(name, None)
+
+                return
+
+    def ready(self):
+        return all(status == 'ready' for status in self.status.values())
+
+    def report(self):
+        return {
+            'ready': self.ready(),
+            'tasks': {
+                name: {
+                    'status': self.status[name],
+                    'error': self.errors.get(name),
+                    'duration': self.durations.get(name)
+                } for name in self.tasks
+            }
+        }
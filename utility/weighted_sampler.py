@@ -0,0 +1,117 @@
+import threading
+
+import numpy as np
+
+
+class WeightedSampler:
+    """
+    Samples positions with probability proportional to their weight, without replacement, using a Fenwick tree
+    over the weights. Excluded positions are either rejected on draw or masked out for the duration of a call,
+    whichever is cheaper, so a call costs O((k + excluded) log n) at worst and never copies the weights.
+    """
+
+    # Below this share of excluded weight, excluded draws are rejected instead of masked
+    REJECTION_LIMIT = 0.5
+
+    def __init__(self, weights, seed=None):
+        self.weights = np.asarray(weights, dtype=np.float64).copy()
+        self.size = len(self.weights)
+        self.random = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+        self._tree = np.concatenate([[0.0], self.weights])
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self._tree[parent] += self._tree[i]
+
+        self._step = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def seed(self, seed):
+        self.random = np.random.default_rng(seed)
+
+    def total(self):
+        return self._prefix(self.size)
+
+    def _prefix(self, i):
+        total = 0.0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+
+        return total
+
+    def _add(self, position, delta):
+        i = position + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _set(self, position, weight):
+        self._add(position, weight - self.weights[position])
+        self.weights[position] = weight
+
+    def _find(self, value):
+        # Smallest position whose cumulative weight exceeds value
+        position = 0
+        step = self._step
+        while step:
+            following = position + step
+            if following <= self.size and self._tree[following] <= value:
+                position = following
+                value -= self._tree[following]
+            step >>= 1
+
+        return min(position, self.size - 1)
+
+    def _mask(self, positions, masked):
+        for position in positions:
+            if position not in masked:
+                masked[position] = self.weights[position]
+                self._set(position, 0.0)
+
+    def sample(self, count, exclude=()):
+        """
+        Draws up to count distinct positions, never returning a position in exclude.
+        """
+        exclude = np.unique(np.asarray(exclude, dtype=np.int64))
+        result = []
+        masked = {}
+
+        with self._lock:
+            try:
+                excluded = self.weights[exclude].sum() if len(exclude) else 0.0
+                if excluded > self.REJECTION_LIMIT * self.total():
+                    self._mask(exclude, masked)
+                    excluded = 0.0
+
+                rejected = set(exclude.tolist()) if excluded else set()
+                rejections = 0
+
+                while len(result) < count:
+                    total = self.total()
+                    if total - excluded <= 1e-9 * max(1.0, total):
+                        break
+
+                    position = self._find(self.random.random() * total)
+                    if position in rejected or not self.weights[position]:
+                        rejections += 1
+
+                        # Once sampled positions have drained most of the weight, masking becomes cheaper
+                        if rejections > 4 * count + 16:
+                            if not rejected:
+                                break
+
+                            self._mask(exclude, masked)
+                            excluded = 0.0
+                            rejected = set()
+
+                        continue
+
+                    result.append(position)
+                    self._mask([position], masked)
+            finally:
+                for position, weight in masked.items():
+                    self._set(position, weight)
+
+        return np.asarray(result, dtype=np.int64)